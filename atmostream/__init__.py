@@ -1 +1,3 @@
-from .forecast import Forecast
\ No newline at end of file
+from .forecast import Forecast, supported_models
+from .orchestrator import StreamOrchestrator
+from .conversion import ConversionQueue
\ No newline at end of file
@@ -0,0 +1,146 @@
+################################################################################
+
+import threading
+import multiprocessing
+from itertools import count
+from time import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+################################################################################
+
+class ConversionQueue:
+
+    ############################################################################
+
+    def __init__(self, max_workers=2, max_jobs=4, max_history=100, mp_context=None):
+        assert max_workers >= 1, 'max_workers must be at least 1...'
+        assert max_jobs >= 1, 'max_jobs must be at least 1...'
+        assert max_history >= 0, 'max_history must be at least 0...'
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.max_history = max_history
+        #{job id: job}, jobs are kept after finishing so their status can be looked up
+        self.jobs = {}
+        self._ids = count()
+        #reentrant, futures that are already done run their callback right away
+        self._lock = threading.RLock()
+        #forking a process that runs download threads can copy held locks into the workers
+        if mp_context is None:
+            mp_context = multiprocessing.get_context('spawn')
+        self._pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+
+    ############################################################################
+
+    @property
+    def active(self):
+        with self._lock:
+            return [j['id'] for j in self.jobs.values() if not j['reported']]
+
+    @property
+    def full(self):
+        return len(self.active) >= self.max_jobs
+
+    def submit(self, func, *args, key=None, callback=None, block=False, priority=0):
+        #func must be picklable, jobs sharing a key (an output folder) run one after the other
+        #waiting jobs with a higher priority are started first
+        #returns the job id, or None when the queue is full and block is False
+        while True:
+            with self._lock:
+                if len([j for j in self.jobs.values() if not j['reported']]) < self.max_jobs:
+                    job_id = next(self._ids)
+                    self.jobs[job_id] = {'id': job_id,
+                                         'func': func,
+                                         'args': args,
+                                         'key': key,
+                                         'callback': callback,
+                                         'priority': priority,
+                                         'future': None,
+                                         'status': 'waiting',
+                                         'submitted': time(),
+                                         'finished': None,
+                                         'result': None,
+                                         'error': None,
+                                         'reported': False}
+                    break
+            if not block:
+                return None
+            self._wait_any()
+        self._dispatch()
+        return job_id
+
+    def status(self, job_id):
+        job = self.jobs[job_id]
+        if job['status'] == 'queued' and job['future'].running():
+            return 'running'
+        return job['status']
+
+    def poll(self):
+        #collect finished jobs and run their callbacks on the calling thread
+        with self._lock:
+            finished = [j for j in self.jobs.values() if j['status'] in ['done', 'failed'] and not j['reported']]
+            for job in finished:
+                job['reported'] = True
+        for job in finished:
+            if job['callback'] is not None:
+                job['callback'](job)
+        self._trim()
+        return finished
+
+    def wait(self):
+        while len(self.active) > 0:
+            self._wait_any()
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.wait()
+        self._pool.shutdown(wait=wait)
+
+    ############################################################################
+
+    def _dispatch(self):
+        #start waiting jobs whose key is free, highest priority first then in submission order
+        #only as many as there are workers, so a later job with a higher priority can still go first
+        with self._lock:
+            queued = [j for j in self.jobs.values() if j['status'] == 'queued']
+            busy = set([j['key'] for j in queued])
+            slots = self.max_workers - len(queued)
+            waiting = [j for j in self.jobs.values() if j['status'] == 'waiting']
+            for job in sorted(waiting, key=lambda j: (-j['priority'], j['id'])):
+                if slots <= 0:
+                    break
+                if job['key'] is not None and job['key'] in busy:
+                    continue
+                slots -= 1
+                job['status'] = 'queued'
+                job['future'] = self._pool.submit(job['func'], *job['args'])
+                job['future'].add_done_callback(lambda f, job=job: self._finish(job, f))
+                busy.add(job['key'])
+
+    def _finish(self, job, future):
+        with self._lock:
+            job['finished'] = time()
+            try:
+                job['result'] = future.result()
+                job['status'] = 'done'
+            except Exception as err:
+                job['error'] = err
+                job['status'] = 'failed'
+        self._dispatch()
+
+    def _wait_any(self):
+        with self._lock:
+            futures = [j['future'] for j in self.jobs.values() if j['status'] == 'queued']
+        if len(futures) > 0:
+            wait(futures, return_when=FIRST_COMPLETED)
+        self.poll()
+
+    def _trim(self):
+        with self._lock:
+            reported = [i for i, j in self.jobs.items() if j['reported']]
+            #reported[:-0] would keep everything
+            if self.max_history > 0:
+                reported = reported[:-self.max_history]
+            for job_id in reported:
+                del self.jobs[job_id]
+
+################################################################################
@@ -0,0 +1,461 @@
+################################################################################
+
+import os
+import re
+import json
+import heapq
+import random
+import threading
+from itertools import count
+from time import time, sleep
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime as dt
+from datetime import timezone
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from .grib import parse_idx, select_idx_messages, merge_idx_ranges, range_header
+
+################################################################################
+
+#requests per second allowed for hosts known to throttle or ban aggressive clients
+default_request_rates = {'nomads.ncep.noaa.gov': 2}
+
+#responses worth retrying
+retry_statuses = [429, 500, 502, 503, 504]
+
+class IncompleteDownloadError(IOError):
+    pass
+
+def parse_retry_after(header):
+    #either a number of seconds or an http date
+    if header is None:
+        return None
+    try:
+        return max(float(header), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - dt.now(timezone.utc)).total_seconds(), 0.0)
+
+def parse_content_range(header):
+    #'bytes start-end/total', total may be '*' when unknown
+    m = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', header or '')
+    assert m is not None, f'Could not parse Content-Range header: {header}'
+    total = None if m.group(3) == '*' else int(m.group(3))
+    return int(m.group(1)), total
+
+class TokenBucket:
+
+    ############################################################################
+
+    def __init__(self, rate, capacity=None):
+        assert rate > 0, 'rate must be positive...'
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._last = time()
+        self._lock = threading.Lock()
+
+    ############################################################################
+
+    def consume(self, n=1):
+        #take n tokens, blocking until the bucket has refilled enough
+        with self._lock:
+            now = time()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last)*self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens/self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            sleep(wait)
+
+################################################################################
+
+class DownloadEngine:
+
+    ############################################################################
+
+    def __init__(self, max_workers=8, max_per_host=4, chunk_size=64*1024, resume_attempts=3,
+                 bandwidth=None, host_bandwidth=None, request_rate=None, host_request_rates=None,
+                 timeout=(10, 60), max_retries=5, backoff=1.0, max_backoff=120.0):
+        assert max_workers >= 1, 'max_workers must be at least 1...'
+        assert max_per_host >= 1, 'max_per_host must be at least 1...'
+        assert resume_attempts >= 1, 'resume_attempts must be at least 1...'
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.chunk_size = chunk_size
+        self.resume_attempts = resume_attempts
+        #one pooled session shared by every worker, keeps connections alive per host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16,
+                              pool_maxsize=max(max_workers, max_per_host))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        #files waiting for a worker, highest priority first then in submission order
+        self._waiting = []
+        self._seq = count()
+        #bandwidth caps in bytes per second, for all hosts together and for each host
+        self.bandwidth = bandwidth
+        self.host_bandwidth = host_bandwidth
+        self._bucket = TokenBucket(bandwidth) if bandwidth is not None else None
+        self._host_buckets = {}
+        #request rate limits in requests per second, per host
+        self.request_rate = request_rate
+        self.host_request_rates = dict(default_request_rates)
+        self.host_request_rates.update(host_request_rates or {})
+        self._request_buckets = {}
+        self._host_blocked = {}
+        #connect/read timeouts and exponential backoff on throttling and server errors
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'rate': 0.0}
+
+    ############################################################################
+
+    def get(self, url, **kwargs):
+        return self.request(url, **kwargs)
+
+    def request(self, url, method='GET', **kwargs):
+        #the body is read before the host slot is given back
+        kwargs['stream'] = False
+        with self.stream(url, method=method, **kwargs) as response:
+            return response
+
+    @contextmanager
+    def stream(self, url, method='GET', **kwargs):
+        #every request goes through here: rate limit, host cap, timeout and retries
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('stream', True)
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_host(url)
+            with self._host_slot(url):
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    if attempt == self.max_retries:
+                        raise
+                    response = None
+                if response is not None and (response.status_code not in retry_statuses or attempt == self.max_retries):
+                    with response:
+                        yield response
+                    return
+                retry_after = None
+                if response is not None:
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    response.close()
+            self._backoff(url, attempt, retry_after)
+
+    def download_file(self, link, out_pth):
+        if not os.path.isdir(out_pth):
+            os.makedirs(out_pth, exist_ok=True)
+        filename = os.path.basename(link)
+        out_file = f'{out_pth}/{filename}'
+        #interrupted transfers keep their .part file and pick up where they stopped
+        nbytes = 0
+        for attempt in range(self.resume_attempts):
+            try:
+                result = self._fetch(link, out_file)
+                result['bytes'] += nbytes
+                return result
+            except (IncompleteDownloadError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as err:
+                if attempt == self.resume_attempts - 1:
+                    raise
+                nbytes += getattr(err, 'nbytes', 0)
+                self._backoff(link, attempt)
+
+    def download_subset(self, link, out_pth, patterns):
+        if not os.path.isdir(out_pth):
+            os.makedirs(out_pth, exist_ok=True)
+        filename = os.path.basename(link)
+        out_file = f'{out_pth}/{filename}'
+        tmp_file = out_file + '.part'
+        #read the inventory published next to the grib file
+        idx = self.request(link + '.idx')
+        idx.raise_for_status()
+        messages = select_idx_messages(parse_idx(idx.text), patterns)
+        assert len(messages) > 0, f'No messages in {link}.idx match {patterns}...'
+        ranges = merge_idx_ranges(messages)
+        #grib2 messages are self contained, concatenating them gives a valid file
+        nbytes = 0
+        with open(tmp_file, 'wb') as f:
+            for start, end in ranges:
+                headers = {'Range': range_header(start, end)}
+                with self.stream(link, headers=headers) as dl:
+                    dl.raise_for_status()
+                    if dl.status_code != 206:
+                        raise IOError(f'Server ignored range request for {link}...')
+                    head = b''
+                    tail = b''
+                    size = 0
+                    for chunk in dl.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+                        self._throttle(link, len(chunk))
+                        if len(head) < 4:
+                            head = (head + chunk)[:4]
+                        tail = (tail + chunk)[-4:]
+                if end is not None and size != end - start + 1:
+                    raise IncompleteDownloadError(f'Incomplete range {start}-{end} of {link}: got {size} bytes...')
+                if head != b'GRIB' or tail != b'7777':
+                    raise IOError(f'Range {start}-{end} of {link} is not a complete grib message...')
+                nbytes += size
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, out_file)
+        return {'link': link,
+                'file': out_file,
+                'bytes': nbytes,
+                'size': nbytes,
+                'etag': None,
+                'validated': True,
+                'subset': list(patterns)}
+
+    def download(self, links, out_pth, desc='Downloading files...', subset=None, callback=None, stop=None,
+                 priority=0):
+        #stop is an optional threading.Event, once set no new files are started
+        #when several downloads share the engine, free workers take the files of the highest priority first
+        t1 = time()
+        nbytes = 0
+        nfiles = 0
+        pool = self.pool
+        futures = []
+        for link in links:
+            if stop is not None and stop.is_set():
+                break
+            if subset is None:
+                futures.append(self._submit(pool, priority, self.download_file, link, out_pth))
+            elif link.endswith('.idx'):
+                #inventories can not be subset themselves, they are fetched whole
+                futures.append(self._submit(pool, priority, self.download_file, link, out_pth))
+            else:
+                futures.append(self._submit(pool, priority, self.download_subset, link, out_pth, subset))
+        pbar = tqdm(as_completed(futures), total=len(futures), desc=desc)
+        try:
+            for future in pbar:
+                if stop is not None and stop.is_set():
+                    #files already being fetched are finished and reported, the rest never start
+                    for f in futures:
+                        f.cancel()
+                if future.cancelled():
+                    continue
+                result = future.result()
+                nbytes += result['bytes']
+                #callbacks run here, on the calling thread
+                if callback is not None:
+                    callback(result)
+                nfiles += 1
+                delta = max(time() - t1, 1e-6)
+                pbar.set_postfix(MBps=f'{nbytes/delta/1e6:.2f}')
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        delta = time() - t1
+        self.stats = {'files': nfiles,
+                      'bytes': nbytes,
+                      'seconds': delta,
+                      'rate': nbytes/delta if delta > 0 else 0.0}
+        if nfiles > 0:
+            tqdm.write(f'Downloaded {nfiles} files, {nbytes/1e6:.1f} MB in {delta:.1f} sec ({self.stats["rate"]/1e6:.2f} MB/s)')
+        return self.stats
+
+    @property
+    def pool(self):
+        #one worker pool for the lifetime of the engine, shared by every forecast using it
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+        self.session.close()
+
+    ############################################################################
+
+    def _submit(self, pool, priority, func, *args):
+        #every pool task runs whichever waiting file comes first, not necessarily the one it was submitted for
+        future = Future()
+        with self._lock:
+            heapq.heappush(self._waiting, (-priority, next(self._seq), future, func, args))
+        pool.submit(self._run_next)
+        return future
+
+    def _run_next(self):
+        with self._lock:
+            _, _, future, func, args = heapq.heappop(self._waiting)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as err:
+            future.set_exception(err)
+
+    def _fetch(self, link, out_file):
+        #write to a temporary file first so a partial download never looks complete
+        tmp_file = out_file + '.part'
+        meta_file = tmp_file + '.json'
+        offset, meta = self._read_partial(tmp_file, meta_file)
+        headers = {}
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+            #only continue if the remote file is still the one we started on
+            validator = meta.get('etag') or meta.get('last_modified')
+            if validator is not None:
+                headers['If-Range'] = validator
+        nbytes = 0
+        with self.stream(link, headers=headers) as dl:
+            if dl.status_code == 416:
+                #nothing left to fetch, either the partial is complete or it is stale
+                if meta.get('size') == offset:
+                    return self._finish_partial(link, tmp_file, meta_file, out_file, 0, meta)
+                self._remove_partial(tmp_file, meta_file)
+                raise IncompleteDownloadError(f'Stale partial download of {link}, restarting...')
+            dl.raise_for_status()
+            if dl.status_code == 206:
+                start, total = parse_content_range(dl.headers.get('Content-Range'))
+                etag = dl.headers.get('ETag')
+                if start != offset or (meta.get('size') not in [None, total]) or \
+                   (meta.get('etag') is not None and etag is not None and etag != meta['etag']):
+                    self._remove_partial(tmp_file, meta_file)
+                    raise IncompleteDownloadError(f'Partial download of {link} does not match server, restarting...')
+                mode = 'ab'
+            else:
+                #server sent the whole file, either a fresh start or the file changed
+                offset = 0
+                total = None
+                #content-length is the encoded size, only comparable for identity transfers
+                if 'Content-Encoding' not in dl.headers and dl.headers.get('Content-Length') is not None:
+                    total = int(dl.headers['Content-Length'])
+                mode = 'wb'
+            meta = {'url': link,
+                    'etag': dl.headers.get('ETag'),
+                    'last_modified': dl.headers.get('Last-Modified'),
+                    'size': total}
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+            with open(tmp_file, mode) as f:
+                try:
+                    for chunk in dl.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        nbytes += len(chunk)
+                        self._throttle(link, len(chunk))
+                except requests.exceptions.RequestException as err:
+                    err.nbytes = nbytes
+                    raise
+                finally:
+                    f.flush()
+                    os.fsync(f.fileno())
+        size = offset + nbytes
+        if total is not None and size < total:
+            err = IncompleteDownloadError(f'Incomplete download of {link}: got {size} of {total} bytes...')
+            err.nbytes = nbytes
+            raise err
+        if total is not None and size > total:
+            self._remove_partial(tmp_file, meta_file)
+            raise IOError(f'Download of {link} is larger than expected: got {size} of {total} bytes...')
+        return self._finish_partial(link, tmp_file, meta_file, out_file, nbytes, meta)
+
+    def _read_partial(self, tmp_file, meta_file):
+        if not os.path.isfile(tmp_file):
+            return 0, {}
+        #a partial without its validators can not be trusted
+        if not os.path.isfile(meta_file):
+            self._remove_partial(tmp_file, meta_file)
+            return 0, {}
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+        except ValueError:
+            self._remove_partial(tmp_file, meta_file)
+            return 0, {}
+        if meta.get('etag') is None and meta.get('last_modified') is None:
+            self._remove_partial(tmp_file, meta_file)
+            return 0, {}
+        if meta.get('etag') is not None and meta['etag'].startswith('W/'):
+            meta['etag'] = None
+        return os.path.getsize(tmp_file), meta
+
+    def _finish_partial(self, link, tmp_file, meta_file, out_file, nbytes, meta):
+        os.replace(tmp_file, out_file)
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        return {'link': link,
+                'file': out_file,
+                'bytes': nbytes,
+                'size': os.path.getsize(out_file),
+                'etag': meta.get('etag'),
+                'validated': meta.get('size') is not None,
+                'subset': None}
+
+    def _remove_partial(self, tmp_file, meta_file):
+        for f in [tmp_file, meta_file]:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def _throttle(self, url, nbytes):
+        if self._bucket is not None:
+            self._bucket.consume(nbytes)
+        if self.host_bandwidth is not None:
+            host = urlparse(url).netloc
+            with self._lock:
+                if host not in self._host_buckets:
+                    self._host_buckets[host] = TokenBucket(self.host_bandwidth)
+                bucket = self._host_buckets[host]
+            bucket.consume(nbytes)
+
+    def _wait_for_host(self, url):
+        host = urlparse(url).netloc
+        #a host that asked us to back off is left alone by every worker
+        blocked = self._host_blocked.get(host, 0) - time()
+        if blocked > 0:
+            sleep(blocked)
+        rate = self.host_request_rates.get(host, self.request_rate)
+        if rate is None:
+            return
+        with self._lock:
+            if host not in self._request_buckets:
+                self._request_buckets[host] = TokenBucket(rate)
+            bucket = self._request_buckets[host]
+        bucket.consume(1)
+
+    def _backoff(self, url, attempt, retry_after=None):
+        #exponential backoff with full jitter, never shorter than what the server asked for
+        wait = random.uniform(0, min(self.max_backoff, self.backoff*2**attempt))
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+            host = urlparse(url).netloc
+            with self._lock:
+                self._host_blocked[host] = max(self._host_blocked.get(host, 0), time() + retry_after)
+        sleep(wait)
+
+    #cap the number of simultaneous requests to a single host
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+############################################################################
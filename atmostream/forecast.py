@@ -2,15 +2,20 @@
 
 import os
 from datetime import datetime as dt
-import requests
-from bs4 import BeautifulSoup as bs
 import re
-import glob
-from tqdm import tqdm
+import asyncio
+import threading
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 
-from .mikeio_support import to_dfs, remove_dfs
+from .mikeio_support import append_to_dfs, convert_forecast, remove_dfs, get_clip_window
+from .grib import prune_grib_cache
+from .engine import DownloadEngine
+from .listing import ListingCache, DateIndex
+from .manifest import Manifest
+from .scheduler import PollScheduler
+from .conversion import ConversionQueue
 
 ################################################################################
 
@@ -56,17 +61,20 @@ class Forecast:
     
     ############################################################################
     
-    def __init__(self, model, output_path=None):
+    def __init__(self, model, output_path=None, engine=None):
         assert model in supported_models, f"Choose a model from: {supported_models}"
         self.model = model
         self.source = source_mapper(model)
         self.set_output_path(output_path)
+        self.set_engine(engine)
+        self.set_listing_cache()
+        self.set_priority()
         
     ############################################################################
     
     @property
     def status(self):
-        p = requests.get(self.data_url)
+        p = self.engine.get(self.data_url)
         return p.status_code
     
     @property
@@ -106,6 +114,35 @@ class Forecast:
             self._output_path = os.path.abspath('.')
         if not os.path.isdir(self.output_path):
             os.mkdir(self.output_path)
+        #every downloaded link, its validation and conversion state
+        self.manifest = Manifest(f'{self.output_path}/manifest.sqlite')
+    
+    def set_engine(self, engine=None, max_workers=8, max_per_host=4):
+        if engine is not None:
+            self.engine = engine
+        else:
+            self.engine = DownloadEngine(max_workers=max_workers, max_per_host=max_per_host)
+        if hasattr(self, 'listing'):
+            self.listing.engine = self.engine
+    
+    def set_listing_cache(self, ttl=60, ttls=None, persist=False, max_entries=1024, max_age=2*86400):
+        #ttls: {url regex: seconds} overrides, persist keeps the cache between restarts
+        cache_file = None
+        if persist:
+            cache_file = f'{self.output_path}/{self.source}_{self.model}_listing.json'
+        self.listing = ListingCache(self.engine, ttl=ttl, ttls=ttls, cache_file=cache_file,
+                                    max_entries=max_entries, max_age=max_age)
+    
+    def set_priority(self, priority=0):
+        #higher priority downloads and conversions go first on a shared engine or conversion queue
+        self.priority = priority
+    
+    def set_conversion_queue(self, queue=None, max_workers=2, max_jobs=4):
+        #conversions run in worker processes while the stream keeps polling, used by streams with background=True
+        if queue is not None:
+            self.conversion = queue
+        else:
+            self.conversion = ConversionQueue(max_workers=max_workers, max_jobs=max_jobs)
     
     def get_available_days(self, reset=True):
         if reset:
@@ -136,24 +173,27 @@ class Forecast:
                 return forecasts
 
     def get_available_files(self, date, forecast):
+        return list(self.iter_available_files(date, forecast, ordered=True))
+    
+    def iter_available_files(self, date, forecast, ordered=False):
         if self.source == 'EC':
-            links = []
             url = self._get_forecast_url(date) + f'/{forecast}/'
-            page = requests.get(url) 
-            soup = bs(page.text, features="html.parser")
-            matches = soup.find_all('a')
-            for match in matches:
-                h = match.get('href')
-                hh = re.search('^(\d+)/', h)
+            hurls = []
+            lookup = self._get_listing_patterns()['lead_hour']
+            for h in self.listing.get_links(url):
+                hh = lookup.search(h)
                 if hh is not None:
-                    hurl = f"{url}{hh.group(1)}/"
-                    page = requests.get(hurl)
-                    soup = bs(page.text, features="html.parser")
-                    matches = soup.find_all('a')
-                    _links = [f"{hurl}/{m.get('href')}" for m in matches if '.grib2' in m.get('href')]
-                    links.extend(_links)
+                    hurls.append(f"{url}{hh.group(1)}/")
+            #crawl the lead hour folders concurrently, yielding files as each one resolves
+            with ThreadPoolExecutor(max_workers=self.engine.max_workers) as pool:
+                if ordered:
+                    results = pool.map(self._get_lead_hour_files, hurls)
+                else:
+                    futures = [pool.submit(self._get_lead_hour_files, hurl) for hurl in hurls]
+                    results = (future.result() for future in as_completed(futures))
+                for _links in results:
+                    yield from _links
         elif self.source == 'NOAA':
-            links = []
             mod =  self.model.split('_')[0].lower()
             if 'gfs' in self.model.lower():
                 url = self._get_forecast_url(date) + f'{forecast}/atmos/'
@@ -164,21 +204,19 @@ class Forecast:
             else:
                 url = self._get_forecast_url(date)
                 pattern = f'^{mod}.t{forecast}z.'
-            page = requests.get(url) 
-            soup = bs(page.text, features="html.parser")
-            matches = soup.find_all('a')
-            for match in matches:
-                h = match.get('href')
-                if re.search(pattern, h):
-                    links.append(f"{url}/{h}")
+            pattern = re.compile(pattern)
+            for h in self.listing.get_links(url):
+                if pattern.search(h):
+                    yield f"{url}/{h}"
         else:
             assert False, f'Model source "{self.source}" not supported...'
-        return links
     
-    def set_download_params(self, date, forecast, variables, verify=True):
+    def set_download_params(self, date, forecast, variables, verify=True, subset=None):
+        #subset: None for whole files, True for the model defaults, or a list of .idx patterns
         self._download_params = {'date':date,
                                  'forecast': forecast,
-                                 'variables': variables}
+                                 'variables': variables,
+                                 'subset': subset}
         out_fld = self.output_path + f'/{self.source}-{self.model}-{date}-{forecast}'
         if not os.path.isdir(out_fld):
             os.mkdir(out_fld)
@@ -188,17 +226,27 @@ class Forecast:
         return 0       
     
     def get_download_files(self, check_output_path=False):
+        return list(self.iter_download_files(check_output_path=check_output_path, ordered=True))
+    
+    def iter_download_files(self, check_output_path=False, ordered=False):
         p = self.download_params
-        avail_files = self.get_available_files(p['date'], p['forecast'])
-        out_files = self._filter_files_by_vars(avail_files, p['variables'])
+        subset = self._get_subset_patterns()
         if check_output_path:
-            exists = glob.glob(self._download_path+'/*') 
-            exists = [os.path.basename(e) for e in exists if os.path.isfile(e)]
-            out_files = [o for o in out_files if os.path.basename(o) not in exists]            
-        return out_files
+            done = self.manifest.get_subsets(self._download_path)
+        for link in self.iter_available_files(p['date'], p['forecast'], ordered=ordered):
+            if len(self._filter_files_by_vars([link], p['variables'])) == 0:
+                continue
+            #the inventories describe the whole files, not the subsets
+            if subset is not None and link.endswith('.idx'):
+                continue
+            if check_output_path and self._is_downloaded(link, done, subset):
+                continue
+            yield link
     
     def set_stream_params(self, startdate, startforecast, variables, sleep, verify=True, convert_to_dfs=False,
-                          auto_delete=True, logging=True):
+                          auto_delete=True, logging=True, subset=None, adaptive=False, incremental=False,
+                          background=False, convert_workers=1, bbox=None, bbox_crs='lonlat',
+                          grib_cache_dir=None):
         self._stream_params = {'startdate': startdate,
                                'startforecast': startforecast,
                                'variables': variables,
@@ -206,209 +254,111 @@ class Forecast:
                                'convert': convert_to_dfs,
                                'delete': auto_delete,
                                'logging': logging,
-                               'verify': verify}
+                               'verify': verify,
+                               'subset': subset,
+                               'adaptive': adaptive,
+                               'incremental': incremental,
+                               'background': background,
+                               'workers': convert_workers,
+                               'bbox': bbox,
+                               'bbox_crs': bbox_crs,
+                               'cache_dir': grib_cache_dir}
         if verify:
             self._verify_stream_params()
     
-    def download(self, check_output_path=False):
-        links = self.get_download_files(check_output_path=check_output_path)
-        for link in tqdm(links, desc=f'Downloading files...'):
-            self._download_file(link, self._download_path)
+    def set_scheduler(self, min_sleep=15, max_sleep=1800, window=600):
+        #learns when each lead hour is published, used by streams with adaptive=True
+        history_file = f'{self.output_path}/{self.source}_{self.model}_arrivals.json'
+        self.scheduler = PollScheduler(history_file, min_sleep=min_sleep, max_sleep=max_sleep, window=window)
+    
+    def predicted_next_arrival(self):
+        state = getattr(self, '_stream_state', None)
+        if state is None or not hasattr(self, 'scheduler'):
+            return None
+        return self.scheduler.predict_next_arrival(self._get_cycle_time(state['day'], state['forecast']))
+    
+    def download(self, check_output_path=False, stop=None):
+        links = self.iter_download_files(check_output_path=check_output_path)
+        subset = self._get_subset_patterns()
+        return self.engine.download(links, self._download_path, desc=f'Downloading files...', subset=subset,
+                                    callback=self._record_download, stop=stop, priority=self.priority)
     
     def stream(self):
-        #global catch all for now
+        self.start_stream()
         try:
-            #initially set to starting stream params
-            p = self.stream_params
-            day = p['startdate']
-            forecast = p['startforecast']
-            vars = p['variables']
-            convert = p['convert']
-            delete = p['delete']
-            logging = p['logging']
-            verify = p['verify']
-            #logging
+            while True:
+                wait = self.stream_step()
+                if wait > 0:
+                    self._log('Waiting...')
+                    sleep(wait)
+        finally:
+            self.stop_stream()
+    
+    def start_stream(self):
+        #initially set to starting stream params
+        p = self.stream_params
+        self._converting = set()
+        self._stream_state = {'day': p['startdate'],
+                              'forecast': p['startforecast'],
+                              'phase': 'wait',
+                              'watched': None,
+                              'stop': threading.Event(),
+                              'pruned': None,
+                              'log': None}
+        if p['adaptive'] and not hasattr(self, 'scheduler'):
+            self.set_scheduler()
+        if p['background'] and not hasattr(self, 'conversion'):
+            self.set_conversion_queue()
+        #logging
+        if p['logging']:
             log_file = f'{self.output_path}/{self.source}_{self.model}_{dt.utcnow().isoformat().replace(":","-")}.log'
-            if logging:
-                f = open(log_file, 'w')
-                f.write('STARTING PARAMETERS:\n')
-                f.write(day+'\n')
-                f.write(forecast+'\n')
-                f.write(str(vars)+'\n')
-                f.write(str(convert)+'\n')
-                f.write(str(delete)+'\n')
-                f.flush()
+            self._stream_state['log'] = open(log_file, 'w')
+            self._log('STARTING PARAMETERS:')
+            self._log(p['startdate'])
+            self._log(p['startforecast'])
+            self._log(str(p['variables']))
+            self._log(str(p['convert']))
+            self._log(str(p['incremental']))
+            self._log(str(p['background']))
+            self._log(str(p['delete']))
+    
+    def stop_stream(self):
+        state = getattr(self, '_stream_state', None)
+        if state is not None:
+            state['stop'].set()
+        #let running conversions finish so the manifest knows what was converted
+        if state is not None and self.stream_params['background']:
+            self.conversion.wait()
+        self.listing.save()
+        if state is not None and state['log'] is not None:
+            state['log'].close()
+            state['log'] = None
+    
+    def stream_step(self):
+        #one polling pass, returns the number of seconds to wait before the next one
+        t1 = dt.now()
+        phase = 'check'
+        while phase != 'wait':
+            phase = self._run_stream_phase(phase)
+        return self._finish_stream_step(t1)
+    
+    async def astream(self):
+        #same passes as stream, with every phase run off the event loop so many forecasts can be awaited together
+        self.start_stream()
+        try:
             while True:
-                print(f'{self.model} download parameters - date : {day}, forecast : {forecast}, vars : {vars}')
-                #reset switches
-                nextfc = False
-                nextday = False
-                #start timer
                 t1 = dt.now()
-                if logging:
-                    f.write(f"\n{t1}\n")
-                    f.write(f'{self.model} download parameters - date : {day}, forecast : {forecast}, vars : {vars}\n')
-                    f.flush()
-                #set the download parameters
-                self.set_download_params(day, forecast, vars, verify=verify)
-                #get the new files to download based on current parameters
-                files = self.get_download_files(check_output_path=True)
-                if logging:
-                    f.write(f"Available Files to Download:\n")
-                    for file in files:
-                        f.write(file+'\n')
-                    f.flush()
-                #check which forecast we're on
-                allfc = self.get_available_forecasts(day)
-                if logging:
-                    f.write(f"Available Forecasts on this day:\n")
-                    for fc in allfc:
-                        f.write(fc+'\n')
-                #what days are even available
-                alldays = self.get_available_days(reset=False)
-                if logging:
-                    f.write(f"Available Days:\n")
-                    for d in alldays:
-                        f.write(d+'\n')
-                    f.flush()
-                #if no files, next fc... if files, download them
-                if len(files) == 0:
-                    #if its the latest forecast, might not be downloaded yet
-                    if day==alldays[-1] and forecast==allfc[-1]:
-                        if logging:
-                            f.write('Monitoring latest forecast, but no data. Waiting...\n')
-                        nextfc = False
-                    else:
-                        if logging:
-                            f.write('Already fetched all files for this forecast...\n')
-                            f.flush()
-                        nextfc = True
-                        if convert:
-                            if logging:
-                                f.write(f"Converting this forecast into DFS format...\n")
-                                f.flush()
-                            to_dfs(self._download_path, self.source, self.model, self.download_params['variables'])
-                            if delete:
-                                if logging:
-                                    f.write("Removing original raw files...\n")
-                                    f.flush()
-                                remove_dfs(self._download_path, self.source, self.model, self.download_params['variables'])
-                else:
-                    if logging:
-                        f.write('Downloading files...\n')
-                        f.flush()
-                    nextfc = False
-                    self.download(check_output_path=True)
-                #do we need to switch days
-                if forecast == allfc[-1] and nextfc:
-                    if logging:
-                        f.write('Already on last forecast, switching to next day...\n')
-                        f.flush()
-                    nextday = True
-                else:
-                    if logging:
-                        f.write('Still more forecasts or more data in current forecast, staying on this day...\n')
-                        f.flush()
-                    nextday = False                
-                #can we switch days
-                if day == alldays[-1]:
-                    canswitch = False
-                    if logging:
-                        f.write('Already on last day, cannot switch to next day yet...\n')
-                        f.flush()
-                else:
-                    canswitch = True
-                    if logging:
-                        f.write('Not on last day, can switch to next day...\n')
-                        f.flush()
-                #EC specific
-                if self.source == 'EC':
-                    if ((dt.utcnow().hour < int(forecast))):
-                        canswitch = True
-                        nextfc = True
-                        nextday = True
-                        alldays = self.get_available_days()
-                        if logging:
-                            f.write('EC model - UTC day has switched over. Switching to next day to avoid downloading duplicated data...\n')
-                            f.write(f"Available Days:\n")
-                            for d in alldays:
-                                f.write(d+'\n')
-                            f.flush()
-                else:
-                    pass
-                #decide what the next download is
-                if nextfc and not nextday:
-                    if logging:
-                        f.write('NEXT STEP: next forecast on the current day...\n')
-                        f.flush()
-                    forecast = allfc[allfc.index(forecast)+1]
-                elif nextfc and nextday:
-                    if logging:
-                        f.write('Need to switch to next forecast and day...\n')
-                        f.flush()
-                    if canswitch:
-                        if logging:
-                            f.write('NEXT STEP: can switch, next forecast on the next day...\n')
-                            f.flush()
-                        if self.source == 'EC':
-                            day = alldays[-1]
-                        else:
-                            day = alldays[alldays.index(day)+1]
-                        newfcs = self.get_available_forecasts(day)
-                        forecast = newfcs[0]
-                    else:
-                        if logging:
-                            f.write('NEXT STEP: no new day of data yet...\n')
-                            f.flush()
-                        pass
-                elif not nextfc and not nextday:
-                    if logging:
-                        f.write('NEXT STEP: check current forecast again for more data...\n')
-                        f.flush()
-                    pass
-                t2 = dt.now()
-                delta = (t2-t1).total_seconds()
-                if logging:
-                    f.write(f"{t2} took {delta} sec\n")
-                    f.flush()
-                if delta < p['sleep']:
-                    wait = p['sleep'] - delta
-                    if logging:
-                        f.write('Waiting...\n')
-                        f.flush()
-                    sleep(wait)
-        #if something goes wrong, assume reinitializing on latest forecast date
-        except Exception as err:       
-            if logging:
-                f.write(repr(err)+'\n')
-                f.flush()
-            #check if last download settings still valid
-            alldays = self.get_available_days()
-            if day in alldays:
-                newday = day
-                allfcs = self.get_available_forecasts(day)
-                if forecast in allfcs:
-                    newfc = forecast
-                else:
-                    newfc = allfcs[-1]
-            else:
-                newday = alldays[0]
-                newfc = self.get_available_forecasts(newday)[0]
-            #reset streaming parameters
-            if logging:
-                f.write(f'RESETTING STREAM PARAMETERS TO {newday} {newfc}\n')
-                f.flush()
-                f.close()  
-            self.set_stream_params(newday, 
-                                   newfc,
-                                   self.stream_params['variables'], 
-                                   self.stream_params['sleep'],
-                                   convert_to_dfs=self.stream_params['convert'],
-                                   auto_delete=self.stream_params['delete'],
-                                   logging=self.stream_params['logging'])
-            #restart streaming
-            self.stream()
-                     
+                phase = 'check'
+                while phase != 'wait':
+                    phase = await self._arun_stream_phase(phase)
+                wait = self._finish_stream_step(t1)
+                if wait > 0:
+                    self._log('Waiting...')
+                    await asyncio.sleep(wait)
+        finally:
+            #waiting on the conversion queue blocks, keep it off the event loop
+            await asyncio.to_thread(self.stop_stream)
+    
     ############################################################################
     
     #get model website
@@ -470,52 +420,91 @@ class Forecast:
                'CFS': ['pressfc', 'wnd10m', 'tmpsfc']}
         return vrs[self.model]
     
+    #.idx patterns of the grib messages each variable needs
+    def _get_subset_fields(self):
+        fields = {'NAM_conusnest': {'u10': [':UGRD:10 m above ground:'],
+                                    'v10': [':VGRD:10 m above ground:'],
+                                    'sp': [':PRES:surface:']}}
+        return fields.get(self.model, {})
+    
+    def _get_subset_patterns(self):
+        p = self.download_params
+        if p['subset'] is None:
+            return None
+        elif p['subset'] is True:
+            fields = self._get_subset_fields()
+            patterns = []
+            for v in p['variables']:
+                patterns.extend(fields[v])
+            return patterns
+        else:
+            return list(p['subset'])
+    
     def _get_available_days(self, nowcast=False):
         if self.source in ['NOAA']:
             mod = self.model.split('_')[0].lower()
-            p = requests.get(self.data_url)
-            soup = bs(p.text, features="html.parser")
-            matches = soup.find_all('a')
+            if mod == 'cfs':
+                return self._get_available_cfs_days(nowcast=nowcast)
             dates = []
-            for match in matches:
-                if mod == 'cfs':
-                    t = match.get('href')
-                    yr = re.search(f'(\d+)/', t)
-                    if yr is not None:
-                        year = yr.group(1)
-                        #this will skip reading all the years for nowcast
-                        if nowcast and int(year) != dt.utcnow().year:
-                            pass
-                        else:
-                            print(f'Fetching available dates from {year}...')
-                            year_url = self.data_url + f'/{year}'
-                            yp = requests.get(year_url)
-                            ysoup = bs(yp.text, features="html.parser")
-                            ymatches = ysoup.find_all('a')
-                            for ymatch in ymatches:
-                                t = ymatch.get('href')
-                                mo = re.search(f'(\d+)/', t)
-                                if mo is not None:
-                                    month = mo.group(1)
-                                    month_url = year_url + f'/{month}'
-                                    mp = requests.get(month_url)
-                                    msoup = bs(mp.text, features="html.parser")
-                                    mmatches = msoup.find_all('a')
-                                    for mmatch in mmatches:
-                                        t = mmatch.get('href')
-                                        dy = re.search(f'(\d+)/', t)
-                                        if dy is not None:
-                                            day = dy.group(1)
-                                            dates.append(day)
-                else:
-                    t = match.get('href')
-                    fc = re.search(f'{mod}.(\d+)/', t)
-                    if fc is not None:
-                        dates.append(fc.group(1))
+            lookup = self._get_listing_patterns()['days']
+            for t in self.listing.get_links(self.data_url):
+                fc = lookup.search(t)
+                if fc is not None:
+                    dates.append(fc.group(1))
         else:
             assert False, f'Model source "{self.source}" not supported...'
         return dates
     
+    #archive dates are kept in an on disk index, only recent months are crawled again
+    def _get_available_cfs_days(self, nowcast=False):
+        index = DateIndex(f'{self.output_path}/{self.source}_{self.model}_dates.json')
+        now = dt.utcnow()
+        #anything older than last month will not receive new days
+        last_month = (pd.Timestamp(now.year, now.month, 1) - pd.DateOffset(months=1)).strftime('%Y%m')
+        folder = self._get_listing_patterns()['folder']
+        for t in self.listing.get_links(self.data_url):
+            yr = folder.search(t)
+            if yr is None:
+                continue
+            year = yr.group(1)
+            #this will skip reading all the years for nowcast
+            if nowcast and int(year) != now.year:
+                continue
+            if year in index.final_years:
+                continue
+            print(f'Fetching available dates from {year}...')
+            year_url = self.data_url + f'/{year}'
+            page = self.listing.get_page(year_url)
+            #a failed or empty listing leaves the year unresolved, it is retried on the next poll
+            if page['status'] != 200:
+                continue
+            months = []
+            for t in page['links']:
+                mo = folder.search(t)
+                if mo is not None:
+                    months.append(mo.group(1))
+            if len(months) == 0:
+                continue
+            for month in months:
+                if month in index.final_months:
+                    continue
+                month_url = year_url + f'/{month}'
+                page = self.listing.get_page(month_url)
+                if page['status'] != 200:
+                    continue
+                days = []
+                for t in page['links']:
+                    dy = folder.search(t)
+                    if dy is not None:
+                        days.append(dy.group(1))
+                index.set_month(month, days, final=month < last_month and len(days) > 0)
+            if int(year) < now.year and all([m in index.final_months for m in months]):
+                index.set_year_final(year)
+        dates = index.days
+        if nowcast:
+            dates = [d for d in dates if int(d[:4]) == now.year]
+        return dates
+    
     def _get_forecast_url(self, date):
         if self.source == 'EC':
             url = self.data_url
@@ -532,7 +521,11 @@ class Forecast:
             assert False, f'Model source "{self.source}" not supported...'
         return url    
 
-    def _get_available_forecasts(self, url):
+    #listing patterns are compiled once per model
+    def _get_listing_patterns(self):
+        if hasattr(self, '_listing_patterns'):
+            return self._listing_patterns
+        mod = self.model.split('_')[0].lower()
         if self.source == 'EC':
             lookup = '^(\d+)/'
         elif self.source == 'NOAA':
@@ -546,13 +539,17 @@ class Forecast:
                 lookup = '\d{8}(\d{2})/'
         else:
             assert False, f'Model source "{self.source}" not supported...'
-        p = requests.get(url)
-        soup = bs(p.text, features="html.parser")
-        matches = soup.find_all('a')
+        self._listing_patterns = {'days': re.compile(f'{mod}.(\d+)/'),
+                                  'forecasts': re.compile(lookup),
+                                  'folder': re.compile('(\d+)/'),
+                                  'lead_hour': re.compile('^(\d+)/')}
+        return self._listing_patterns
+    
+    def _get_available_forecasts(self, url):
+        lookup = self._get_listing_patterns()['forecasts']
         forecasts = []
-        for match in matches:
-            t = match.get('href')
-            fc = re.search(lookup, t)
+        for t in self.listing.get_links(url):
+            fc = lookup.search(t)
             if fc is not None:
                 forecasts.append(fc.group(1))
         return sorted(list(set(forecasts)))
@@ -572,6 +569,14 @@ class Forecast:
         check = all([v in vars for v in p['variables']])
         msg = f'Not all requeste variables found available variables: {vars}'
         assert check, msg
+        #check subsetting is possible
+        if p['subset'] is not None:
+            msg = 'Subsetting by .idx inventory is only available for NOAA models...'
+            assert self.source == 'NOAA', msg
+            if p['subset'] is True:
+                fields = self._get_subset_fields()
+                msg = f'No default subset fields for {self.model}, pass a list of .idx patterns instead...'
+                assert all([v in fields for v in p['variables']]), msg
         return 0 
     
     def _verify_stream_params(self):
@@ -590,6 +595,15 @@ class Forecast:
         check = all([v in vars for v in p['variables']])
         msg = f'Not all requeste variables found available variables: {vars}'
         assert check, msg
+        #check incremental conversion has something to convert
+        if p['incremental'] or p['background']:
+            msg = 'Incremental and background conversion need convert_to_dfs=True...'
+            assert p['convert'], msg
+        #check the clipping box overlaps the model grid
+        if p['bbox'] is not None:
+            msg = 'Clipping to a bbox needs convert_to_dfs=True...'
+            assert p['convert'], msg
+            get_clip_window(self.model, p['bbox'], p['bbox_crs'])
         return 0 
     
     def _filter_files_by_vars(self, files, vars):
@@ -609,13 +623,331 @@ class Forecast:
             assert False, f'Model source "{self.source}" not supported...'
         return links
     
+    #a polling pass moves through these phases until it reaches 'wait'
+    def _stream_phase(self, phase):
+        self._stream_state['phase'] = phase
+        phases = {'check': self._check_phase,
+                  'download': self._download_phase,
+                  'append': self._append_phase,
+                  'convert': self._convert_phase,
+                  'advance': self._advance_phase,
+                  'recover': self._recover_phase}
+        return phases[phase]()
+    
+    #global catch all, errors are recovered in place so a long running stream never restarts
+    def _run_stream_phase(self, phase):
+        if self._stream_state['stop'].is_set():
+            return 'wait'
+        try:
+            return self._stream_phase(phase)
+        except Exception as err:
+            self._log(repr(err))
+            if phase == 'recover':
+                self._log('Could not reset stream parameters, retrying on next step...')
+                return 'wait'
+            return 'recover'
+    
+    async def _arun_stream_phase(self, phase):
+        #a thread can not be cancelled, on cancellation the phase is asked to stop and awaited
+        task = asyncio.ensure_future(asyncio.to_thread(self._run_stream_phase, phase))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            self._stream_state['stop'].set()
+            await asyncio.wait([task])
+            raise
+    
+    def _finish_stream_step(self, t1):
+        p = self.stream_params
+        t2 = dt.now()
+        delta = (t2-t1).total_seconds()
+        self._log(f"{t2} took {delta} sec")
+        wait = p['sleep']
+        if p['adaptive']:
+            state = self._stream_state
+            wait = self.scheduler.next_wait(self._get_cycle_time(state['day'], state['forecast']), p['sleep'])
+            self._log(f"Next arrival expected at {self.predicted_next_arrival()}, polling again in {wait:.0f} sec")
+        return max(wait - delta, 0)
+    
+    def _observe_arrivals(self, files):
+        state = self._stream_state
+        cycle_time = self._get_cycle_time(state['day'], state['forecast'])
+        #everything of this cycle that is on the server, whether downloaded already or not
+        links = self.manifest.get_links(self._download_path) | set(files)
+        leads = set([self._get_lead_hour(l) for l in links])
+        #the latest cycle listed once the stream has caught up, every later cycle was published while watching
+        if state['watched'] is None and state['day'] == state['alldays'][-1]:
+            state['watched'] = self._get_cycle_time(state['day'], state['allfc'][-1])
+        appeared = state['watched'] is not None and cycle_time > state['watched']
+        new = self.scheduler.observe(cycle_time, leads, appeared=appeared)
+        if len(new) > 0:
+            self._log(f"New lead hours published: {new}")
+        self.scheduler.forget(cycle_time - pd.Timedelta(days=2))
+    
+    def _get_cycle_time(self, day, forecast):
+        return dt.strptime(day[:8] + forecast, '%Y%m%d%H')
+    
+    def _get_lead_hour(self, link):
+        if self.source == 'EC':
+            lead = re.search('/(\d{3})/+[^/]+$', link)
+        else:
+            lead = re.search('f(\d{2,3})(\.|$)', os.path.basename(link))
+        #single files holding the whole forecast, like CFS time series
+        if lead is None:
+            return 'all'
+        return lead.group(1)
+    
+    def _check_phase(self):
+        p = self.stream_params
+        state = self._stream_state
+        day = state['day']
+        forecast = state['forecast']
+        vars = p['variables']
+        if p['background']:
+            self.conversion.poll()
+        print(f'{self.model} download parameters - date : {day}, forecast : {forecast}, vars : {vars}')
+        self._log(f"\n{dt.now()}")
+        self._log(f'{self.model} download parameters - date : {day}, forecast : {forecast}, vars : {vars}')
+        #set the download parameters
+        self.set_download_params(day, forecast, vars, verify=p['verify'], subset=p['subset'])
+        #get the new files to download based on current parameters
+        files = self.get_download_files(check_output_path=True)
+        self._log(f"Available Files to Download:")
+        for file in files:
+            self._log(file)
+        #check which forecast we're on
+        allfc = self.get_available_forecasts(day)
+        self._log(f"Available Forecasts on this day:")
+        for fc in allfc:
+            self._log(fc)
+        #what days are even available
+        alldays = self.get_available_days(reset=False)
+        self._log(f"Available Days:")
+        for d in alldays:
+            self._log(d)
+        state['allfc'] = allfc
+        state['alldays'] = alldays
+        if p['adaptive']:
+            self._observe_arrivals(files)
+        #if no files, next fc... if files, download them
+        if len(files) > 0:
+            state['nextfc'] = False
+            return 'download'
+        #if its the latest forecast, might not be downloaded yet
+        if day==alldays[-1] and forecast==allfc[-1]:
+            self._log('Monitoring latest forecast, but no data. Waiting...')
+            state['nextfc'] = False
+            return 'advance'
+        self._log('Already fetched all files for this forecast...')
+        state['nextfc'] = True
+        if p['convert']:
+            return 'convert'
+        return 'advance'
+    
+    def _download_phase(self):
+        p = self.stream_params
+        self._log('Downloading files...')
+        self.download(check_output_path=True, stop=self._stream_state['stop'])
+        if p['convert'] and p['incremental']:
+            return 'append'
+        return 'advance'
+    
+    def _append_phase(self):
+        p = self.stream_params
+        links = self._get_unconverted()
+        if len(links) == 0:
+            return 'advance'
+        args = (self._download_path, self.source, self.model, self.download_params['variables'], list(links),
+                p['bbox'], p['bbox_crs'], p['cache_dir'])
+        if p['background']:
+            #never block downloading, files left out are picked up by the next pass
+            job = self.conversion.submit(append_to_dfs, *args, key=self._download_path, priority=self.priority,
+                                         callback=lambda job, links=links: self._finish_append(job['result'], links, job['error']))
+            if job is None:
+                self._log('Conversion queue is full, appending on a later pass...')
+                return 'advance'
+            self._converting |= set(links.values())
+            self._log(f'Queued {len(links)} files for appending as job {job}...')
+        else:
+            self._log('Appending new lead hours to the DFS files...')
+            self._finish_append(append_to_dfs(*args), links)
+        return 'advance'
+    
+    def _convert_phase(self):
+        p = self.stream_params
+        #files held by queued appends too, in case those fail, lead hours they did append are skipped
+        links = self._get_unconverted(queued=True)
+        #raw files are only removed once the manifest shows all of them converted
+        args = (self._download_path, self.source, self.model, self.download_params['variables'], list(links),
+                p['incremental'], False, p['workers'], p['bbox'], p['bbox_crs'], p['cache_dir'])
+        if p['background']:
+            #the stream moves on to the next forecast, so this one has to be queued even if it has to wait
+            folder = self._download_path
+            job = self.conversion.submit(convert_forecast, *args, key=folder, block=True, priority=self.priority,
+                                         callback=lambda job, links=links: self._finish_convert(folder, job['result'], links, job['error']))
+            self._converting |= set(links.values())
+            self._log(f'Queued this forecast for DFS conversion as job {job}...')
+        else:
+            self._log(f"Converting this forecast into DFS format...")
+            self._finish_convert(self._download_path, convert_forecast(*args), links)
+        return 'advance'
+    
+    def _advance_phase(self):
+        state = self._stream_state
+        #grib indexes of files removed outside the stream, checked once a day
+        if state['pruned'] is None or (dt.utcnow() - state['pruned']).total_seconds() > 86400:
+            prune_grib_cache(self.stream_params['cache_dir'])
+            state['pruned'] = dt.utcnow()
+        day = state['day']
+        forecast = state['forecast']
+        allfc = state['allfc']
+        alldays = state['alldays']
+        nextfc = state['nextfc']
+        #do we need to switch days
+        if forecast == allfc[-1] and nextfc:
+            self._log('Already on last forecast, switching to next day...')
+            nextday = True
+        else:
+            self._log('Still more forecasts or more data in current forecast, staying on this day...')
+            nextday = False                
+        #can we switch days
+        if day == alldays[-1]:
+            canswitch = False
+            self._log('Already on last day, cannot switch to next day yet...')
+        else:
+            canswitch = True
+            self._log('Not on last day, can switch to next day...')
+        #EC specific
+        if self.source == 'EC':
+            if ((dt.utcnow().hour < int(forecast))):
+                canswitch = True
+                nextfc = True
+                nextday = True
+                alldays = self.get_available_days()
+                self._log('EC model - UTC day has switched over. Switching to next day to avoid downloading duplicated data...')
+                self._log(f"Available Days:")
+                for d in alldays:
+                    self._log(d)
+        else:
+            pass
+        #decide what the next download is
+        if nextfc and not nextday:
+            self._log('NEXT STEP: next forecast on the current day...')
+            forecast = allfc[allfc.index(forecast)+1]
+        elif nextfc and nextday:
+            self._log('Need to switch to next forecast and day...')
+            if canswitch:
+                self._log('NEXT STEP: can switch, next forecast on the next day...')
+                if self.source == 'EC':
+                    day = alldays[-1]
+                else:
+                    day = alldays[alldays.index(day)+1]
+                newfcs = self.get_available_forecasts(day)
+                forecast = newfcs[0]
+            else:
+                self._log('NEXT STEP: no new day of data yet...')
+                pass
+        elif not nextfc and not nextday:
+            self._log('NEXT STEP: check current forecast again for more data...')
+            pass
+        state['day'] = day
+        state['forecast'] = forecast
+        return 'wait'
+    
+    def _recover_phase(self):
+        self._recover_stream()
+        return 'wait'
+    
+    #if something goes wrong, assume reinitializing on latest forecast date
+    def _recover_stream(self):
+        state = self._stream_state
+        day = state['day']
+        forecast = state['forecast']
+        #check if last download settings still valid
+        alldays = self.get_available_days()
+        if day in alldays:
+            newday = day
+            allfcs = self.get_available_forecasts(day)
+            if forecast in allfcs:
+                newfc = forecast
+            else:
+                newfc = allfcs[-1]
+        else:
+            newday = alldays[0]
+            newfc = self.get_available_forecasts(newday)[0]
+        #reset streaming parameters
+        self._log(f'RESETTING STREAM PARAMETERS TO {newday} {newfc}')
+        state['day'] = newday
+        state['forecast'] = newfc
+    
+    def _get_unconverted(self, queued=False):
+        #{file: link} of every downloaded file not converted yet, and not in a queued conversion unless queued
+        rows = self.manifest.get_files(self._download_path, converted=False, removed=False)
+        return {f"{self._download_path}/{r['filename']}": r['link'] for r in rows
+                if queued or r['link'] not in self._converting}
+    
+    def _finish_append(self, converted, links, error=None):
+        self._converting -= set(links.values())
+        if error is not None:
+            self._log(f'Appending failed, retrying on a later pass: {error!r}')
+            return
+        self.manifest.set_converted(os.path.dirname(list(links)[0]), links=[links[f] for f in converted if f in links])
+        self._log(f"Appended {len(converted)} files")
+    
+    def _finish_convert(self, folder, result, links, error=None):
+        self._converting -= set(links.values())
+        if error is not None:
+            self._log(f'Converting {folder} failed: {error!r}')
+            return
+        if result['full']:
+            self.manifest.set_converted(folder)
+        else:
+            self.manifest.set_converted(folder, links=[links[f] for f in result['converted'] if f in links])
+        if self.stream_params['delete']:
+            left = self.manifest.get_files(folder, converted=False, removed=False)
+            if len(left) > 0:
+                self._log(f"Keeping original raw files in {folder}, {len(left)} were not converted...")
+                return
+            remove_dfs(folder, self.source, self.model, self.stream_params['variables'],
+                       cache_dir=self.stream_params['cache_dir'])
+            self._log(f"Removed original raw files in {folder}...")
+            self.manifest.set_removed(folder)
+    
+    def _log(self, msg):
+        state = getattr(self, '_stream_state', None)
+        if state is not None and state['log'] is not None:
+            state['log'].write(msg+'\n')
+            state['log'].flush()
+    
+    def _get_lead_hour_files(self, hurl):
+        return [f"{hurl}/{m}" for m in self.listing.get_links(hurl) if '.grib2' in m]
+    
     def _download_file(self, link, out_pth):
-        if not os.path.isdir(out_pth):
-            os.mkdir(out_pth)
-        filename = os.path.basename(link)
-        dl = requests.get(link)
-        with open(f'{out_pth}/{filename}', 'wb') as f:
-            f.write(dl.content)
+        result = self.engine.download_file(link, out_pth)
+        self._record_download(result)
+        return result
+    
+    def _record_download(self, result):
+        self.manifest.record_download(result['link'],
+                                      self.model,
+                                      os.path.dirname(result['file']),
+                                      os.path.basename(result['file']),
+                                      result['size'],
+                                      etag=result['etag'],
+                                      validated=result['validated'],
+                                      subset=result['subset'])
+    
+    def _is_downloaded(self, link, done, subset=None):
+        #a whole file covers any subset, a subset only a request for the same messages
+        if link in done:
+            return done[link] is None or done[link] == subset
+        #files fetched before the manifest existed are adopted as they are found
+        file = f'{self._download_path}/{os.path.basename(link)}'
+        if os.path.isfile(file):
+            self.manifest.record_download(link, self.model, self._download_path, os.path.basename(link),
+                                          os.path.getsize(file))
+            return True
+        return False
             
 ############################################################################
     
@@ -0,0 +1,250 @@
+################################################################################
+
+import os
+import re
+import json
+import struct
+import hashlib
+from time import time
+from datetime import datetime as dt
+from functools import lru_cache
+import numpy as np
+import eccodes
+
+################################################################################
+
+def parse_idx(text):
+    #NOAA inventory lines look like '12:3456789:d=2023101800:UGRD:10 m above ground:6 hour fcst:'
+    #fields packed in one grib message are numbered '7.1', '7.2'... and share its start byte
+    messages = []
+    for line in text.splitlines():
+        parts = line.strip().split(':')
+        if len(parts) < 7 or not re.fullmatch(r'\d+(\.\d+)?', parts[0]):
+            continue
+        messages.append({'num': parts[0],
+                         'message': int(parts[0].split('.')[0]),
+                         'start': int(parts[1]),
+                         'date': parts[2].replace('d=', ''),
+                         'var': parts[3],
+                         'level': parts[4],
+                         'fcst': parts[5],
+                         'line': line.strip()})
+    messages = sorted(messages, key=lambda m: (m['start'], m['num']))
+    #each message ends where the next one starts, the last one runs to end of file
+    starts = sorted(set([m['start'] for m in messages]))
+    ends = {s: starts[i+1] - 1 if i+1 < len(starts) else None for i, s in enumerate(starts)}
+    for m in messages:
+        m['end'] = ends[m['start']]
+    return messages
+
+def select_idx_messages(messages, patterns):
+    regex = [re.compile(p) for p in patterns]
+    return [m for m in messages if any([r.search(m['line']) for r in regex])]
+
+def merge_idx_ranges(messages):
+    #adjacent messages are fetched in a single range, a message is fetched whole for any of its fields
+    ranges = []
+    for m in sorted(messages, key=lambda m: m['start']):
+        if len(ranges) > 0 and ranges[-1][1] == m['end'] and ranges[-1][0] <= m['start']:
+            continue
+        if len(ranges) > 0 and ranges[-1][1] is not None and ranges[-1][1] + 1 == m['start']:
+            ranges[-1] = (ranges[-1][0], m['end'])
+        else:
+            ranges.append((m['start'], m['end']))
+    return ranges
+
+def range_header(start, end):
+    if end is None:
+        return f'bytes={start}-'
+    return f'bytes={start}-{end}'
+
+################################################################################
+
+#message indexes live outside the data folders, nothing is written next to the grib files
+#ATMOSTREAM_GRIB_CACHE moves them, when the folder can't be written they are only kept in memory
+default_cache_dir = os.environ.get('ATMOSTREAM_GRIB_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'atmostream', 'grib'))
+
+#header keys kept for every message, enough to select fields without decoding them
+index_keys = ['cfVarName', 'shortName', 'typeOfLevel', 'level', 'stepType', 'dataType',
+              'dataDate', 'dataTime', 'validityDate', 'validityTime', 'Ni', 'Nj']
+
+#bumped when the cached indexes change shape, older ones are rescanned
+index_version = 2
+
+def index_grib(file, cache_dir=None):
+    #byte offset, length and header keys of every message, scanned once per version of a file
+    stat = os.stat(file)
+    return _index_grib(os.path.abspath(file), stat.st_mtime, stat.st_size, cache_dir or default_cache_dir)
+
+def select_grib_messages(messages, **keys):
+    #messages whose header matches every key, e.g. typeOfLevel='surface', stepType='instant'
+    return [m for m in messages if all([m.get(k) == v for k, v in keys.items()])]
+
+def read_grib_message(f, message):
+    #decodes one message from an open file, missing points become nan
+    if message.get('field', 0) > 0:
+        #later fields of a multi field message are cut out into a message of their own
+        fields = _get_grib2_fields(f, message['offset'], message['length'])
+        data = _get_field_message(f, fields[message['field']])
+    else:
+        f.seek(message['offset'])
+        data = f.read(message['length'])
+    h = eccodes.codes_new_from_message(data)
+    try:
+        values = eccodes.codes_get_values(h).astype(np.float32)
+        if eccodes.codes_get(h, 'bitmapPresent'):
+            values[values == eccodes.codes_get(h, 'missingValue')] = np.nan
+    finally:
+        eccodes.codes_release(h)
+    return values.reshape(message['Nj'], message['Ni'])
+
+def read_grib(file, selections, cache_dir=None):
+    #one open of the file for every requested field, selections are lists of header keys to match
+    #returns the first matching message and its values for each selection, None when nothing matches
+    messages = index_grib(file, cache_dir=cache_dir)
+    out = []
+    with open(file, 'rb') as f:
+        for keys in selections:
+            found = select_grib_messages(messages, **keys)
+            if len(found) == 0:
+                out.append(None)
+            else:
+                out.append((found[0], read_grib_message(f, found[0])))
+    return out
+
+def valid_time(message):
+    return dt.strptime(f"{message['validityDate']}{message['validityTime']:04d}", '%Y%m%d%H%M')
+
+def reference_time(message):
+    return dt.strptime(f"{message['dataDate']}{message['dataTime']:04d}", '%Y%m%d%H%M')
+
+def forget_grib_index(file, cache_dir=None):
+    #drop the index of a file that is being removed
+    cache_file = _get_cache_file(os.path.abspath(file), cache_dir or default_cache_dir)
+    try:
+        os.remove(cache_file)
+    except OSError:
+        pass
+    _index_grib.cache_clear()
+
+def prune_grib_cache(cache_dir=None, max_age=7*24*3600):
+    #indexes of files that were never removed through forget_grib_index,
+    #dropped once their grib file is gone or they haven't been rewritten for max_age seconds
+    cache_dir = cache_dir or default_cache_dir
+    if not os.path.isdir(cache_dir):
+        return
+    now = time()
+    for name in os.listdir(cache_dir):
+        pth = os.path.join(cache_dir, name)
+        try:
+            stale = now - os.path.getmtime(pth) > max_age
+            if not stale and name.endswith('.json'):
+                with open(pth) as f:
+                    stale = not os.path.isfile(json.load(f)['file'])
+        except (ValueError, KeyError):
+            stale = True
+        except OSError:
+            continue
+        if stale:
+            try:
+                os.remove(pth)
+            except OSError:
+                pass
+
+################################################################################
+
+@lru_cache(maxsize=1024)
+def _index_grib(file, mtime, size, cache_dir):
+    cache_file = _get_cache_file(file, cache_dir)
+    try:
+        with open(cache_file) as f:
+            index = json.load(f)
+        if index.get('version') == index_version and index['mtime'] == mtime and index['size'] == size:
+            return index['messages']
+    except (ValueError, KeyError, OSError):
+        pass
+    messages = []
+    #raw is read separately, eccodes keeps its own position in f
+    with open(file, 'rb') as f, open(file, 'rb') as raw:
+        while True:
+            h = eccodes.codes_grib_new_from_file(f, headers_only=True)
+            if h is None:
+                break
+            try:
+                message = {'offset': int(eccodes.codes_get(h, 'offset')),
+                           'length': int(eccodes.codes_get(h, 'totalLength')),
+                           'field': 0}
+                message.update(_get_index_keys(h))
+                edition = eccodes.codes_get(h, 'edition')
+            finally:
+                eccodes.codes_release(h)
+            messages.append(message)
+            if edition != 2:
+                continue
+            #'7.1' style fields packed after the first one, each gets its own entry
+            fields = _get_grib2_fields(raw, message['offset'], message['length'])
+            for i in range(1, len(fields)):
+                h = eccodes.codes_new_from_message(_get_field_message(raw, fields[i]))
+                try:
+                    messages.append({'offset': message['offset'],
+                                     'length': message['length'],
+                                     'field': i,
+                                     **_get_index_keys(h)})
+                finally:
+                    eccodes.codes_release(h)
+    #an unwritable cache folder only costs a rescan in the next process, the lru_cache still holds it
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': index_version, 'file': file, 'mtime': mtime, 'size': size,
+                       'messages': messages}, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+    return messages
+
+def _get_cache_file(file, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha1(file.encode()).hexdigest() + '.json')
+
+def _get_index_keys(h):
+    keys = {}
+    for k in index_keys:
+        try:
+            keys[k] = eccodes.codes_get(h, k)
+        except eccodes.KeyValueNotFoundError:
+            keys[k] = None
+    return keys
+
+def _get_grib2_fields(f, offset, length):
+    #walks the section headers of a grib2 message, every section 7 closes a field
+    #each field is {section number: (start, length)} of the sections it is decoded with
+    fields = []
+    sections = {}
+    pos = offset + 16
+    while pos < offset + length - 4:
+        f.seek(pos)
+        size, number, indicator = struct.unpack('>IBB', f.read(6))
+        #bitmap indicator 254 reuses the bitmap given for an earlier field
+        if not (number == 6 and indicator == 254 and 6 in sections):
+            sections[number] = (pos, size)
+        if number == 7:
+            fields.append(dict(sections))
+        pos += size
+    return fields
+
+def _get_field_message(f, field):
+    #single field grib2 message, the indicator section is rebuilt with the new total length
+    body = b''
+    for number in sorted(field):
+        f.seek(field[number][0])
+        body += f.read(field[number][1])
+    f.seek(field[1][0] - 16)
+    indicator = f.read(8)
+    return indicator + struct.pack('>Q', 16 + len(body) + 4) + body + b'7777'
+
+################################################################################
@@ -0,0 +1,211 @@
+################################################################################
+
+import os
+import re
+import json
+import threading
+from time import time
+from collections import OrderedDict
+from html import unescape
+
+################################################################################
+
+class ListingCache:
+
+    ############################################################################
+
+    def __init__(self, engine, ttl=60, ttls=None, cache_file=None, max_entries=1024, max_age=2*86400,
+                 save_interval=60):
+        self.engine = engine
+        self.ttl = ttl
+        #{url regex: ttl in seconds}, the first matching pattern wins
+        self.ttls = {re.compile(k): v for k, v in (ttls or {}).items()}
+        self.cache_file = cache_file
+        #pages not used for max_age seconds, or the least recently used above max_entries, are dropped
+        self.max_entries = max_entries
+        self.max_age = max_age
+        #the cache file is rewritten at most once per save_interval seconds
+        self.save_interval = save_interval
+        #{url: entry}, least recently used first, only the hrefs and validators of a page are kept
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._saved = time()
+        if cache_file is not None and os.path.isfile(cache_file):
+            self._load()
+
+    ############################################################################
+
+    def get_ttl(self, url):
+        for pattern, ttl in self.ttls.items():
+            if pattern.search(url):
+                return ttl
+        return self.ttl
+
+    def get_links(self, url):
+        return self._get_entry(url)['links']
+
+    def get_page(self, url):
+        #{'status', 'links', ...} of url, error pages have the status of the failed request
+        return self._get_entry(url)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._dirty = True
+        self.save()
+
+    def save(self):
+        #write the cache file now if anything changed since it was last written
+        if self.cache_file is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                entries = {url: dict(e) for url, e in self._entries.items()}
+                self._dirty = False
+                self._saved = time()
+            tmp_file = self.cache_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_file, self.cache_file)
+
+    ############################################################################
+
+    def _get_entry(self, url):
+        now = time()
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                entry['used'] = now
+                self._entries.move_to_end(url)
+        if entry is not None and now - entry['fetched'] < self.get_ttl(url):
+            return entry
+        #revalidate what we already have instead of fetching it again
+        headers = {}
+        if entry is not None:
+            if entry.get('etag') is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified') is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+        page = self.engine.get(url, headers=headers)
+        if page.status_code == 304 and entry is not None:
+            entry['fetched'] = now
+        else:
+            #a page is parsed once per version of it, the text itself is not kept
+            entry = {'status': page.status_code,
+                     'links': extract_hrefs(page.text),
+                     'etag': page.headers.get('ETag'),
+                     'last_modified': page.headers.get('Last-Modified'),
+                     'fetched': now,
+                     'used': now}
+            #error pages are returned but never cached
+            if page.status_code != 200:
+                return entry
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            self._evict(now)
+            self._dirty = True
+            due = now - self._saved >= self.save_interval
+        if due:
+            self.save()
+        return entry
+
+    def _evict(self, now):
+        #called with the lock held
+        while len(self._entries) > 0:
+            url, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - entry['used'] < self.max_age:
+                break
+            del self._entries[url]
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except ValueError:
+            entries = {}
+        for url, entry in sorted(entries.items(), key=lambda e: e[1].get('used', e[1]['fetched'])):
+            #cache files written before only the hrefs were kept
+            if entry.get('links') is None:
+                if entry.get('text') is None:
+                    continue
+                entry['links'] = extract_hrefs(entry.pop('text'))
+            entry.setdefault('used', entry['fetched'])
+            entry.setdefault('status', 200)
+            self._entries[url] = entry
+        self._evict(time())
+
+################################################################################
+
+class DateIndex:
+
+    ############################################################################
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        #{'YYYYMM': ['YYYYMMDD', ...]} plus the months and years that can no longer change
+        self.months = {}
+        self.final_months = set()
+        self.final_years = set()
+        if os.path.isfile(index_file):
+            self._load()
+
+    ############################################################################
+
+    @property
+    def days(self):
+        return sorted([d for days in self.months.values() for d in days])
+
+    def set_month(self, month, days, final=False):
+        self.months[month] = sorted(set(days))
+        if final:
+            self.final_months.add(month)
+        self.save()
+
+    def set_year_final(self, year):
+        self.final_years.add(year)
+        self.save()
+
+    def save(self):
+        index = {'months': self.months,
+                 'final_months': sorted(self.final_months),
+                 'final_years': sorted(self.final_years)}
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    ############################################################################
+
+    def _load(self):
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except ValueError:
+            return
+        self.months = index.get('months', {})
+        self.final_months = set(index.get('final_months', []))
+        self.final_years = set(index.get('final_years', []))
+
+################################################################################
+
+#matches the href attribute of <a> tags, quoted or not, without building a document tree
+href_pattern = re.compile(r'<a\s[^>]*?href\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
+
+def iter_hrefs(text):
+    for m in href_pattern.finditer(text):
+        h = m.group(1)
+        if h is None:
+            h = m.group(2) if m.group(2) is not None else m.group(3)
+        if '&' in h:
+            h = unescape(h)
+        yield h
+
+def extract_hrefs(text):
+    return list(iter_hrefs(text))
+
+############################################################################
@@ -0,0 +1,111 @@
+################################################################################
+
+import json
+import sqlite3
+import threading
+from datetime import datetime as dt
+
+################################################################################
+
+columns = ['link', 'model', 'folder', 'filename', 'size', 'etag',
+           'downloaded', 'validated', 'converted', 'removed', 'subset']
+
+class Manifest:
+
+    ############################################################################
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                                      link TEXT PRIMARY KEY,
+                                      model TEXT,
+                                      folder TEXT,
+                                      filename TEXT,
+                                      size INTEGER,
+                                      etag TEXT,
+                                      downloaded TEXT,
+                                      validated INTEGER,
+                                      converted INTEGER DEFAULT 0,
+                                      removed INTEGER DEFAULT 0,
+                                      subset TEXT)''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_folder ON files (folder)')
+            #manifests written before subsets were recorded
+            names = [r[1] for r in self._conn.execute('PRAGMA table_info(files)').fetchall()]
+            if 'subset' not in names:
+                self._conn.execute('ALTER TABLE files ADD COLUMN subset TEXT')
+
+    ############################################################################
+
+    def record_download(self, link, model, folder, filename, size, etag=None, validated=False, subset=None):
+        #subset is the list of .idx patterns a partial file was fetched with, None for whole files
+        if subset is not None:
+            subset = json.dumps(list(subset))
+        with self._lock, self._conn:
+            self._conn.execute('''INSERT OR REPLACE INTO files
+                                  (link, model, folder, filename, size, etag, downloaded, validated, converted, removed, subset)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, 0, ?)''',
+                               (link, model, folder, filename, size, etag,
+                                dt.utcnow().isoformat(), int(validated), subset))
+
+    def set_converted(self, folder, links=None, converted=True):
+        self._set_flag('converted', folder, links, converted)
+
+    def set_removed(self, folder, links=None, removed=True):
+        self._set_flag('removed', folder, links, removed)
+
+    def get(self, link):
+        with self._lock:
+            row = self._conn.execute(f'SELECT {", ".join(columns)} FROM files WHERE link = ?', (link,)).fetchone()
+        if row is None:
+            return None
+        return self._to_dict(row)
+
+    def get_files(self, folder, converted=None, removed=None):
+        query = f'SELECT {", ".join(columns)} FROM files WHERE folder = ?'
+        args = [folder]
+        if converted is not None:
+            query += ' AND converted = ?'
+            args.append(int(converted))
+        if removed is not None:
+            query += ' AND removed = ?'
+            args.append(int(removed))
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def get_links(self, folder):
+        with self._lock:
+            rows = self._conn.execute('SELECT link FROM files WHERE folder = ?', (folder,)).fetchall()
+        return set([r[0] for r in rows])
+
+    def get_subsets(self, folder):
+        #{link: subset patterns or None} of every file downloaded into folder
+        with self._lock:
+            rows = self._conn.execute('SELECT link, subset FROM files WHERE folder = ?', (folder,)).fetchall()
+        return {r[0]: json.loads(r[1]) if r[1] is not None else None for r in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    ############################################################################
+
+    def _to_dict(self, row):
+        row = dict(zip(columns, row))
+        if row['subset'] is not None:
+            row['subset'] = json.loads(row['subset'])
+        return row
+
+    def _set_flag(self, flag, folder, links, value):
+        with self._lock, self._conn:
+            if links is None:
+                self._conn.execute(f'UPDATE files SET {flag} = ? WHERE folder = ?', (int(value), folder))
+            else:
+                self._conn.executemany(f'UPDATE files SET {flag} = ? WHERE link = ?',
+                                       [(int(value), link) for link in links])
+
+############################################################################
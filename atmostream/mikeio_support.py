@@ -2,16 +2,29 @@
 
 import mikeio
 from mikeio import Grid2D, EUMType, EUMUnit, ItemInfo
+from mikecore.DfsFactory import DfsBuilder, DfsFactory
+from mikecore.DfsFile import DfsSimpleType, TimeAxisType
+from mikecore.DfsFileFactory import DfsFileFactory
+from mikecore.eum import eumQuantity, eumUnit
+from mikecore.Projections import Cartography
 import glob
 from datetime import datetime as dt
 from datetime import timedelta as td
 import re
-import xarray as xr
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import os
+import shutil
+import json
 from more_itertools import sort_together
+from itertools import islice
+from functools import lru_cache
+from collections import deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .grib import index_grib, select_grib_messages, read_grib, read_grib_message, valid_time, reference_time, forget_grib_index
 
 ################################################################################
 
@@ -134,155 +147,395 @@ def get_model_grid(model):
             }
     return grid[model]
 
-def to_dfs(folder, source, model, vars):
+def get_grid(model, window=None):
+    #the model grid, or the part of it inside a clip window
+    params = dict(get_model_grid(model))
+    if window is None:
+        return Grid2D(**params)
+    j0, j1, i0, i1 = window
+    params['nx'] = i1 - i0
+    params['ny'] = j1 - j0
+    if 'origin' in params:
+        params['origin'] = (params['origin'][0] + i0*params['dx'], params['origin'][1] + j0*params['dy'])
+    else:
+        params['x0'] = params['x0'] + i0*params['dx']
+        params['y0'] = params['y0'] + j0*params['dy']
+    return Grid2D(**params)
+
+def get_clip_window(model, bbox, bbox_crs='lonlat'):
+    #rows and columns (j0, j1, i0, i1) of the model grid covering bbox=(west, south, east, north)
+    assert bbox_crs in ['lonlat', 'native'], 'bbox_crs must be "lonlat" or "native"...'
+    return _get_clip_window(model, tuple(bbox), bbox_crs)
+
+def clip_field(data, window):
+    #copied so the full field can be freed right after decoding
+    if window is None:
+        return data
+    j0, j1, i0, i1 = window
+    return np.ascontiguousarray(data[j0:j1, i0:i1])
+
+def to_dfs(folder, source, model, vars, workers=1, bbox=None, bbox_crs='lonlat', cache_dir=None):
+    #bbox=(west, south, east, north) clips the output, in lon/lat or with bbox_crs='native' in grid coordinates
+    window = get_clip_window(model, bbox, bbox_crs) if bbox is not None else None
     if source == 'EC':
-            EC_to_dfs(folder, vars, model)
+            EC_to_dfs(folder, vars, model, workers=workers, window=window, cache_dir=cache_dir)
     elif source == 'NOAA':
         if 'cfs' == model.lower():
-            CFS_to_dfs(folder, vars, model)
+            CFS_to_dfs(folder, vars, model, window=window, cache_dir=cache_dir)
         if model.lower().startswith('nam'):
-            NAM_to_dfs(folder, vars, model)
+            NAM_to_dfs(folder, vars, model, workers=workers, window=window, cache_dir=cache_dir)
 
-def remove_dfs(folder, source, model, vars):
+def convert_forecast(folder, source, model, vars, files, incremental=False, delete=False, workers=1,
+                     bbox=None, bbox_crs='lonlat', cache_dir=None):
+    #files are the raw files not converted yet, anything that can't be appended is converted in full
+    converted = []
+    if incremental and len(files) > 0:
+        converted = append_to_dfs(folder, source, model, vars, files, bbox=bbox, bbox_crs=bbox_crs, cache_dir=cache_dir)
+    full = not incremental or len(set(files) - set(converted)) > 0
+    if full:
+        to_dfs(folder, source, model, vars, workers=workers, bbox=bbox, bbox_crs=bbox_crs, cache_dir=cache_dir)
+    if delete:
+        remove_dfs(folder, source, model, vars, cache_dir=cache_dir)
+    return {'converted': converted, 'full': full}
+
+def remove_dfs(folder, source, model, vars, cache_dir=None):
     if source == 'EC':
-            EC_grib_remove(folder, vars)
+            EC_grib_remove(folder, vars, cache_dir=cache_dir)
     elif source == 'NOAA':
         if 'cfs' == model.lower():
-            CFS_dfs_remove(folder, vars)
+            CFS_dfs_remove(folder, vars, cache_dir=cache_dir)
         if model.lower().startswith('nam'):
-            NAM_dfs_remove(folder)
+            NAM_dfs_remove(folder, cache_dir=cache_dir)
             
-def EC_grib_remove(folder, vars):
+def EC_grib_remove(folder, vars, cache_dir=None):
     var_files = [f for f in glob.glob(f'{folder}/*.grib2') if any([v in f for v in vars])]
     for f in var_files:
+        forget_grib_index(f, cache_dir=cache_dir)
         os.remove(f)
+    #cfgrib indexes left by older versions
     var_files = [f for f in glob.glob(f'{folder}/*.grib2*idx') if any([v in f for v in vars])]
     for f in var_files:
         os.remove(f)
      
-def CFS_dfs_remove(folder, vars):
+def CFS_dfs_remove(folder, vars, cache_dir=None):
     var_files = [f for f in glob.glob(f'{folder}/*.grb2') if any([v in f for v in vars])]
     for f in var_files:
+        forget_grib_index(f, cache_dir=cache_dir)
         os.remove(f)
+    #cfgrib indexes left by older versions
     var_files = [f for f in glob.glob(f'{folder}/*.grb2*idx') if any([v in f for v in vars])]
     for f in var_files:
         os.remove(f)
         
-def NAM_dfs_remove(folder):
-    var_files = [f for f in glob.glob(f'{folder}/*.grb2') if f.lower().startswith('nam.')]
+def NAM_dfs_remove(folder, cache_dir=None):
+    var_files = [f for f in glob.glob(f'{folder}/*.grib2') if os.path.basename(f).lower().startswith('nam.')]
     for f in var_files:
+        forget_grib_index(f, cache_dir=cache_dir)
         os.remove(f)
-    var_files = [f for f in glob.glob(f'{folder}/*.grb2*idx') if f.lower().startswith('nam.')]
+    #cfgrib indexes left by older versions
+    var_files = [f for f in glob.glob(f'{folder}/*.grib2*idx') if os.path.basename(f).lower().startswith('nam.')]
     for f in var_files:
         os.remove(f)
 
-def EC_to_dfs(folder, vars, model):
+def EC_to_dfs(folder, vars, model, workers=1, window=None, cache_dir=None):
     var_files = {var:[f for f in glob.glob(f'{folder}/*.grib2') if var in f] for var in vars}
-    grid = Grid2D(**get_model_grid(model))
+    var_files = {var:sorted(files, key=lambda f: file_to_time(f, model)) for var, files in var_files.items()}
+    grid = get_grid(model, window)
+    #one stream of decodes over every variable so the workers never idle between variables
+    decoded = iter_decoded(EC_read_file, [(f, model, window, cache_dir) for var in vars for f in var_files[var]], workers=workers)
     for var in tqdm(vars, desc=f'{folder}...'):
         files = var_files[var]
         if len(files) == 0:
             continue
         time = [file_to_time(f, model) for f in files]
         typ, unit = var_mapper(var).values()
-        data = []
-        for file in tqdm(files, desc=var):
-            if model == 'GEPS':
-                f = xr.open_dataset(file, filter_by_keys={'dataType':'cf'})
-            else:
-                f = xr.open_dataset(file)
-            dat = f.variables[list(f.variables.keys())[-1]].values
-            data.append(dat)
-        data = np.array(data)
-        data_array = mikeio.DataArray(data,
-                                   geometry=grid,
-                                   time=time,
-                                   item=ItemInfo(var,
-                                                 typ,
-                                                 unit))
-        dataset = mikeio.Dataset([data_array])
-        dataset.to_dfs(f'{folder}/{var}.dfs2')
+        #written as decoded, only one field is held in memory
+        with Dfs2Writer(f'{folder}/{var}.dfs2',
+                        grid=grid,
+                        items=[ItemInfo(var, typ, unit)],
+                        start_time=time[0],
+                        timestep=get_timestep(time)) as writer:
+            for t in tqdm(time, desc=var):
+                writer.write(t, [next(decoded)])
         
-def CFS_to_dfs(folder, vars, model):
+def CFS_to_dfs(folder, vars, model, window=None, cache_dir=None):
     var_files = {var:[f for f in glob.glob(f'{folder}/*.grb2') if var in f] for var in vars}
-    grid = Grid2D(**get_model_grid(model))
+    grid = get_grid(model, window)
     for var in tqdm(vars, desc=f'Converting files in {os.path.basename(folder)}...'):
         files = var_files[var]
         if len(files) == 0:
             continue
         else:
             file=files[0]
+        messages = index_grib(file, cache_dir=cache_dir)
+        names = list(dict.fromkeys([m['cfVarName'] for m in messages]))
         if var == 'wnd10m':
-            typ1, unit1 = var_mapper(var+'_u').values()
-            typ2, unit2 = var_mapper(var+'_v').values()
-            multi = True
-        else:            
-            typ, unit = var_mapper(var).values()
-            multi = False
-        f = xr.open_dataset(file)
-        t0 = f.time.to_numpy()
-        if multi:
-            data1 = f.variables[list(f.variables.keys())[-2]].values[:,::-1,:]
-            data2 = f.variables[list(f.variables.keys())[-1]].values[:,::-1,:]
-            time = np.array([pd.to_datetime(str(t0))+td(hours=i) for i in range(data1.shape[0])])
-            data_array = []
-            for d,name,typ,unit in zip([data1, data2], ['u','v'], [typ1, typ2], [unit1, unit2]):
-                data_array.append(mikeio.DataArray(d,
-                                                    geometry=grid,
-                                                    time=time,
-                                                    item=ItemInfo(var+f'_{name}',
-                                                                    typ,
-                                                                    unit)))
+            names = names[-2:]
+            items = [ItemInfo(var+f'_{name}', *var_mapper(var+f'_{name}').values()) for name in ['u','v']]
         else:
-            data = f.variables[list(f.variables.keys())[-1]].values[:,::-1,:] #flip because of dy being negative
-            time = np.array([pd.to_datetime(str(t0))+td(hours=i) for i in range(data.shape[0])])
-            data_array = [mikeio.DataArray(data,
-                                        geometry=grid,
-                                        time=time,
-                                        item=ItemInfo(var,
-                                                        typ,
-                                                        unit))]
-        dataset = mikeio.Dataset(data_array)
-        dataset.to_dfs(f'{folder}/{var}.dfs2')
-
-def NAM_to_dfs(folder, vars, model):
-    grid = Grid2D(**get_model_grid(model))
+            names = names[-1:]
+            items = [ItemInfo(var, *var_mapper(var).values())]
+        steps = [sorted(select_grib_messages(messages, cfVarName=n), key=valid_time) for n in names]
+        t0 = reference_time(steps[0][0])
+        time = [t0+td(hours=i) for i in range(len(steps[0]))]
+        #the time series is read one step at a time instead of all at once
+        with Dfs2Writer(f'{folder}/{var}.dfs2',
+                        grid=grid,
+                        items=items,
+                        start_time=time[0],
+                        timestep=get_timestep(time)) as writer, open(file, 'rb') as f:
+            for i, t in enumerate(time):
+                writer.write(t, [clip_field(read_grib_message(f, s[i])[::-1,:], window) for s in steps]) #flip because of dy being negative
+
+def NAM_to_dfs(folder, vars, model, workers=1, window=None, cache_dir=None):
+    #every lead hour of the cycle in one file, sorted by valid time
+    grid = get_grid(model, window)
     files = glob.glob(f'{folder}/nam.*{model.lower().split("_")[-1]}*.grib2')
-    for file in tqdm(files, desc=f'Converting files in {os.path.basename(folder)}...'):
-        vs = []
-        dat = []
-        if 'u10' in vars or 'v10' in vars:
-            wind = xr.open_dataset(file, filter_by_keys={'typeOfLevel':'heightAboveGround', 'level':10})
-            if 'u10' in vars:
-                u = wind.variables['u10'].values
-                vs.append('u10')
-                dat.append(u)
-            if 'v10' in vars:
-                v = wind.variables['v10'].values
-                vs.append('v10')
-                dat.append(v)
-        if 'sp' in vars:
-            pres = xr.open_dataset(file, filter_by_keys={'typeOfLevel':'surface', 'stepType':'instant'})
-            p = pres.variables['sp'].values
-            vs.append('sp')
-            dat.append(p)
-        time = wind.time.values
-        data_array = []
-        for var,data in zip(vs,dat):
-            typ, unit = var_mapper(var).values()
-            data_array.append(mikeio.DataArray(data,
-                                            geometry=grid,
-                                            time=time,
-                                            item=ItemInfo(var,
-                                                            typ,
-                                                            unit)))
-        dataset = mikeio.Dataset(data_array)
-        dataset.to_dfs(f'{folder}/{"_".join(vars)}.dfs2')
+    if len(files) == 0:
+        return
+    files = sorted(files, key=lambda f: NAM_file_time(f, vars, cache_dir))
+    time = [NAM_file_time(f, vars, cache_dir) for f in files]
+    vs = [v for v in ['u10', 'v10', 'sp'] if v in vars]
+    items = [ItemInfo(v, *var_mapper(v).values()) for v in vs]
+    decoded = iter_decoded(NAM_read_file, [(f, vars, window, cache_dir) for f in files], workers=workers)
+    with Dfs2Writer(f'{folder}/{"_".join(vars)}.dfs2',
+                    grid=grid,
+                    items=items,
+                    start_time=time[0],
+                    timestep=get_timestep(time)) as writer:
+        for t in tqdm(time, desc=f'Converting files in {os.path.basename(folder)}...'):
+            writer.write(t, next(decoded)[2])
+
+def NAM_file_time(file, vars, cache_dir=None):
+    #from the message headers, nothing is decoded
+    messages = [m for m in index_grib(file, cache_dir=cache_dir) if m['cfVarName'] in vars]
+    if len(messages) == 0:
+        raise IOError(f'None of {vars} found in {file}...')
+    return valid_time(messages[0])
+
+def append_to_dfs(folder, source, model, vars, files, bbox=None, bbox_crs='lonlat', cache_dir=None):
+    #convert only the given raw files, appending their timesteps to the dfs2 files in folder
+    window = get_clip_window(model, bbox, bbox_crs) if bbox is not None else None
+    if source == 'EC':
+        return EC_append_dfs(folder, vars, model, files, window=window, cache_dir=cache_dir)
+    elif source == 'NOAA':
+        if model.lower().startswith('nam'):
+            return NAM_append_dfs(folder, vars, model, files, window=window, cache_dir=cache_dir)
+    #time series models are converted once the forecast is complete
+    return []
+
+def iter_decoded(func, args, workers=1):
+    #func(*a) for every a in args, in order, with at most 2 decodes per worker in flight
+    if workers <= 1:
+        for a in args:
+            yield func(*a)
+        return
+    args = iter(args)
+    #spawned, streams call this from threads and forking those can deadlock the workers
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = deque([pool.submit(func, *a) for a in islice(args, 2*workers)])
+        while len(pending) > 0:
+            result = pending.popleft().result()
+            a = next(args, None)
+            if a is not None:
+                pending.append(pool.submit(func, *a))
+            yield result
+
+def EC_read_file(file, model, window=None, cache_dir=None):
+    if model == 'GEPS':
+        field = read_grib(file, [{'dataType':'cf'}], cache_dir=cache_dir)[0]
+    else:
+        field = read_grib(file, [{}], cache_dir=cache_dir)[0]
+    if field is None:
+        raise IOError(f'No field to convert in {file}...')
+    return clip_field(field[1], window)
+
+def EC_append_dfs(folder, vars, model, files, window=None, cache_dir=None):
+    grid = get_grid(model, window)
+    converted = []
+    for var in vars:
+        var_files = [f for f in files if var in os.path.basename(f)]
+        if len(var_files) == 0:
+            continue
+        var_files = sorted(var_files, key=lambda f: file_to_time(f, model))
+        outfile = f'{folder}/{var}.dfs2'
+        typ, unit = var_mapper(var).values()
+        #lead hours already in the output, e.g. appended by an earlier job
+        present = find_dfs_times(outfile, [file_to_time(f, model) for f in var_files])
+        done = [f for f in var_files if file_to_time(f, model) in present]
+        converted.extend(done)
+        var_files = [f for f in var_files if f not in done]
+        if len(var_files) == 0:
+            continue
+        if os.path.isfile(outfile) and can_append_dfs(outfile, file_to_time(var_files[0], model)):
+            writer = Dfs2Writer(outfile, mode='a')
+        else:
+            if os.path.isfile(outfile):
+                #late or out of order lead hours, rebuild the variable from every file on disk
+                var_files = sorted(set(var_files + [f for f in glob.glob(f'{folder}/*.grib2') if var in os.path.basename(f)]),
+                                   key=lambda f: file_to_time(f, model))
+            writer = Dfs2Writer(outfile, grid=grid, items=[ItemInfo(var, typ, unit)],
+                                start_time=file_to_time(var_files[0], model))
+        with writer:
+            for file in var_files:
+                writer.write(file_to_time(file, model), [EC_read_file(file, model, window, cache_dir)])
+        converted.extend(var_files)
+    #a rebuild covers the lead hours found in the output as well
+    return sorted(set(converted))
+
+def NAM_read_file(file, vars, window=None, cache_dir=None):
+    #every requested field in a single pass over the file
+    keys = {'u10':{'cfVarName':'u10', 'typeOfLevel':'heightAboveGround', 'level':10},
+            'v10':{'cfVarName':'v10', 'typeOfLevel':'heightAboveGround', 'level':10},
+            'sp':{'cfVarName':'sp', 'typeOfLevel':'surface', 'stepType':'instant'}}
+    vs = [v for v in ['u10', 'v10', 'sp'] if v in vars]
+    fields = read_grib(file, [keys[v] for v in vs], cache_dir=cache_dir)
+    for v, field in zip(vs, fields):
+        if field is None:
+            raise IOError(f'{v} not found in {file}...')
+    return valid_time(fields[0][0]), vs, [clip_field(field[1], window) for field in fields]
+
+def NAM_append_dfs(folder, vars, model, files, window=None, cache_dir=None):
+    nam = [f for f in files if os.path.basename(f).lower().startswith('nam.')]
+    #the .idx sidecars are not converted, they go with their grib2 file
+    sidecars = {f[:-len('.idx')]: f for f in nam if f.endswith('.grib2.idx')}
+    files = [f for f in nam if f.endswith('.grib2')]
+    if len(files) == 0:
+        return []
+    grid = get_grid(model, window)
+    outfile = f'{folder}/{"_".join(vars)}.dfs2'
+    times = {f: NAM_file_time(f, vars, cache_dir) for f in files}
+    #lead hours already in the output, e.g. appended by an earlier job
+    present = find_dfs_times(outfile, list(times.values()))
+    done = [f for f in files if times[f] in present]
+    files = sorted([f for f in files if f not in done], key=lambda f: times[f])
+    if len(files) > 0:
+        if os.path.isfile(outfile) and can_append_dfs(outfile, times[files[0]]):
+            writer = Dfs2Writer(outfile, mode='a')
+        else:
+            if os.path.isfile(outfile):
+                #late or out of order files, rebuild from every file on disk
+                old = [f for f in glob.glob(f'{folder}/nam.*{model.lower().split("_")[-1]}*.grib2') if f not in files]
+                times.update({f: NAM_file_time(f, vars, cache_dir) for f in old})
+                files = sorted(files + old, key=lambda f: times[f])
+            vs = [v for v in ['u10', 'v10', 'sp'] if v in vars]
+            items = [ItemInfo(v, *var_mapper(v).values()) for v in vs]
+            writer = Dfs2Writer(outfile, grid=grid, items=items, start_time=times[files[0]])
+        #decoded and written one file at a time
+        with writer:
+            for f in files:
+                writer.write(times[f], NAM_read_file(f, vars, window, cache_dir)[2])
+    converted = sorted(set(done + files))
+    return converted + [sidecars[f] for f in converted if f in sidecars]
+
+def can_append_dfs(file, time):
+    #only files with a calendar axis that can grow, ending before time
+    dfs = DfsFileFactory.DfsGenericOpen(file)
+    try:
+        axis = dfs.FileInfo.TimeAxis
+        if axis.TimeAxisType != TimeAxisType.CalendarNonEquidistant:
+            return False
+        if axis.NumberOfTimeSteps == 0:
+            return True
+        last = dfs.ReadItemTimeStep(1, axis.NumberOfTimeSteps-1).Time
+        return axis.StartDateTime + td(seconds=last) < time
+    finally:
+        dfs.Close()
+
+@lru_cache(maxsize=64)
+def _get_clip_window(model, bbox, bbox_crs):
+    params = get_model_grid(model)
+    grid = Grid2D(**params)
+    west, south, east, north = bbox
+    msg = 'bbox must be (west, south, east, north)...'
+    assert south < north, msg
+    if bbox_crs == 'lonlat':
+        if east < west:
+            east = east + 360
+        #follow the edges of the box, they are curved in most projections
+        lon = np.r_[np.linspace(west, east, 50), np.full(50, east), np.linspace(east, west, 50), np.full(50, west)]
+        lat = np.r_[np.full(50, south), np.linspace(south, north, 50), np.full(50, north), np.linspace(north, south, 50)]
+        if params['projection'] == 'LONG/LAT':
+            #longitudes as used by the grid, 0 to 360 or -180 to 180
+            x = np.unwrap((lon - grid.x[0]) % 360 + grid.x[0], period=360)
+            #a box across the edge of a global grid is not one block of columns, it keeps the full width
+            if grid.nx*grid.dx >= 360 - grid.dx/2 and x.max() > grid.x[0] + (grid.nx - 0.5)*grid.dx:
+                x = np.r_[grid.x[0], grid.x[-1]]
+            y = lat
+        else:
+            cart = Cartography(params['projection'], validateProjectionString=False)
+            x, y = np.array([cart.Geo2Proj(a, b) for a, b in zip(lon, lat)]).T
+        west, east, south, north = x.min(), x.max(), y.min(), y.max()
+    #cells whose centre is within half a cell of the box
+    i0 = max(int(np.floor((west - grid.x[0])/grid.dx + 0.5)), 0)
+    i1 = min(int(np.ceil((east - grid.x[0])/grid.dx + 0.5)), grid.nx)
+    j0 = max(int(np.floor((south - grid.y[0])/grid.dy + 0.5)), 0)
+    j1 = min(int(np.ceil((north - grid.y[0])/grid.dy + 0.5)), grid.ny)
+    msg = f'bbox {bbox} does not overlap the {model} grid...'
+    assert i1 > i0 and j1 > j0, msg
+    return (j0, j1, i0, i1)
+
+def get_timestep(times):
+    #seconds between equidistant times, None when they are not
+    if len(times) < 2:
+        return 1.0
+    steps = np.diff(pd.DatetimeIndex(times)).astype('timedelta64[ms]').astype(np.int64)
+    if steps[0] <= 0 or np.any(steps != steps[0]):
+        return None
+    return steps[0]/1000
+
+def find_dfs_times(file, times):
+    #which of times are in file, the sorted time axis is bisected so only a few steps are read
+    if not os.path.isfile(file):
+        return set()
+    dfs = DfsFileFactory.DfsGenericOpen(file)
+    try:
+        n = dfs.FileInfo.TimeAxis.NumberOfTimeSteps
+        steps = {}
+        def step_time(i):
+            if i not in steps:
+                steps[i] = _get_step_time(dfs, i)
+            return steps[i]
+        found = set()
+        for time in times:
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi)//2
+                if step_time(mid) < time:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < n and step_time(lo) == time:
+                found.add(time)
+        return found
+    finally:
+        dfs.Close()
+
+def get_dfs_index(file):
+    #times, geometry and items of a dfs file without reading its data, once per version of the file
+    stat = os.stat(file)
+    return _get_dfs_index(os.path.abspath(file), stat.st_mtime, stat.st_size)
+
+@lru_cache(maxsize=4096)
+def _get_dfs_index(file, mtime, size):
+    dfs = mikeio.open(file)
+    time = dfs.time
+    if time is None:
+        #non-equidistant axes store the time with each timestep, only the first item is read for it
+        raw = DfsFileFactory.DfsGenericOpen(file)
+        try:
+            seconds = [raw.ReadItemTimeStep(1, i).Time for i in range(raw.FileInfo.TimeAxis.NumberOfTimeSteps)]
+        finally:
+            raw.Close()
+        time = pd.to_datetime(seconds, unit='s', origin=pd.Timestamp(dfs.start_time))
+    return {'time': pd.DatetimeIndex(time),
+            'geometry': dfs.geometry,
+            'items': dfs.items}
 
 def sort_files_by_time(files):
     times = []
     for file in files:
-        t0 = mikeio.read(file, time=[0]).time[0]
+        t0 = get_dfs_index(file)['time'][0]
         times.append(t0)
     out_times, out_files = sort_together([times, files])
     return out_files
@@ -292,74 +545,269 @@ def get_time_matrix(files):
     ids = []
     Fs = []
     for file in files:
-        time = mikeio.read(file).time.tolist()
+        time = get_dfs_index(file)['time'].tolist()
         idx = list(range(len(time)))
         times.extend(time)
         ids.extend(idx)
         Fs.extend([file]*len(time))
-    return pd.DataFrame({'time':times, 'idx':ids, 'file':Fs}).sort_values(by='time')
+    return pd.DataFrame({'time':times, 'idx':ids, 'file':Fs}).sort_values(by='time', kind='stable')
+
+def iter_merged_blocks(matrix):
+    #rows in a row from the same file are read together, so only one file's slab is in memory at a time
+    #yields the first and last+1 row of each block and its data per item
+    files = matrix['file'].values
+    ids = matrix['idx'].values
+    starts = np.r_[0, np.flatnonzero(files[1:] != files[:-1]) + 1]
+    ends = np.r_[starts[1:], len(files)]
+    for s, e in zip(starts, ends):
+        ds = mikeio.read(files[s], time=ids[s:e].tolist(), keepdims=True)
+        yield s, e, [da.values for da in ds]
 
 def get_merged_data(matrix):
-    ids = matrix.groupby(matrix['file'])[['idx']].agg(list)
-    data = {}
-    for file in ids.index:
-        ds = mikeio.read(file, time=ids.loc[file].idx)
-        data[file] = ds
-    shape = ds.geometry.ny, ds.geometry.nx
-    out = np.full((len(matrix),*shape), np.nan)
-    for i in range(out.shape[0]):
-        f = matrix.iloc[i]['file']
-        f_id = matrix.iloc[i]['idx']
-        f_ids = ids.loc[f].idx
-        f_idx = f_ids.index(f_id)
-        dat = data[f][0].values[f_idx]
-        out[i,:,:] = dat
+    out = None
+    for s, e, data in iter_merged_blocks(matrix):
+        if out is None:
+            out = np.full((len(matrix), *data[0].shape[1:]), np.nan)
+        out[s:e] = data[0]
     return out
+
+def write_merged_data(matrix, outfile, geometry, items):
+    #streams the merged timesteps straight into outfile
+    times = pd.DatetimeIndex(matrix['time'])
+    with Dfs2Writer(outfile,
+                    grid=geometry,
+                    items=items,
+                    start_time=times[0],
+                    timestep=get_timestep(times)) as writer:
+        for s, e, data in iter_merged_blocks(matrix):
+            for i in range(e - s):
+                writer.write(times[s+i], [d[i] for d in data])
         
 def concat_dfs(files, outfile):
     files = pd.Series(files)
     files = files.groupby(files.apply(lambda x: os.path.basename(x))).agg(list)
     files = files.apply(sort_files_by_time)
     for var in tqdm(files.index, desc='Concatenating files...'):
-        v = var.replace('.dfs2','')
         fs = files.loc[var]
         matrix = get_time_matrix(fs)
+        #the newest file wins where files overlap
         idx = matrix.groupby(matrix['time'])[matrix.columns].agg('last')
-        data = get_merged_data(idx)
-        typ, unit = var_mapper(v).values()
-        data_array = [mikeio.DataArray(data,
-                                       geometry=mikeio.read(fs[0]).geometry,
-                                       time=idx['time'].tolist(),
-                                       item=ItemInfo(v,
-                                                     typ,
-                                                     unit))]
-        dataset = mikeio.Dataset(data_array)
-        dataset.to_dfs(f'{var}_{outfile}')  
+        index = get_dfs_index(fs[0])
+        write_merged_data(idx, f'{var}_{outfile}', index['geometry'], index['items'])
         
+def update_archive(files, outfile):
+    #rolling version of concat_dfs, each file replaces the overlapping tail of the archive and
+    #appends its new timesteps, so the cost of adding a cycle doesn't grow with the archive
+    files = pd.Series(files)
+    files = files.groupby(files.apply(lambda x: os.path.basename(x))).agg(list)
+    files = files.apply(sort_files_by_time)
+    for var in tqdm(files.index, desc='Updating archives...'):
+        archive = f'{var}_{outfile}'
+        for file in files.loc[var]:
+            append_to_archive(file, archive)
+
+def append_to_archive(file, archive):
+    index = get_dfs_index(file)
+    times = index['time']
+    #the newest cycle wins, from the first newer cycle in the archive on a file only fills missing steps
+    cycles = _read_archive_cycles(archive)
+    newer = [c for c in cycles if c > times[0]]
+    end = min(newer) if len(newer) > 0 else None
+    if end is not None:
+        archived = get_dfs_index(archive)['time']
+        times = times[(times < end) | ~times.isin(archived)]
+        if len(times) == 0:
+            return
+    if not os.path.isfile(archive):
+        tmp_file = f'{archive}.tmp'
+        shutil.copyfile(file, tmp_file)
+        os.replace(tmp_file, archive)
+        _write_archive_cycles(archive, [times[0]])
+        return
+    dfs = DfsFileFactory.DfsGenericOpenEdit(archive)
+    try:
+        msg = f'Items of {file} do not match the archive {archive}...'
+        assert [i.Name for i in dfs.ItemInfo] == [i.name for i in index['items']], msg
+        axis = dfs.FileInfo.TimeAxis
+        n = axis.NumberOfTimeSteps
+        #only the tail from the first new time onwards is looked at, walking back from the end
+        tail = {}
+        for i in range(n-1, -1, -1):
+            t = _get_step_time(dfs, i)
+            if t < times[0]:
+                break
+            #steps of a newer cycle are left alone
+            if end is None or t < end:
+                tail[t] = i
+        last = _get_step_time(dfs, n-1) if n > 0 else None
+        new = [t for t in times if t not in tail]
+        fits = all([t in times for t in tail]) and (last is None or all([t > last for t in new]))
+        if fits and axis.TimeAxisType == TimeAxisType.CalendarEquidistant and n > 0:
+            #an equidistant axis can only grow by its own timestep
+            dt_ = td(seconds=axis.TimeStepInSeconds())
+            fits = all([t == last + (k+1)*dt_ for k, t in enumerate(new)])
+        if fits:
+            _write_archive_steps(dfs, file, times, tail, n, index['time'])
+    finally:
+        dfs.Close()
+    if not fits:
+        #new times fall between archived ones, merge the two files like concat_dfs does
+        matrix = get_time_matrix([archive, file])
+        if end is not None:
+            matrix = matrix[(matrix['file'] != file) | matrix['time'].isin(times)]
+        matrix = matrix.groupby(matrix['time'])[matrix.columns].agg('last')
+        tmp_file = f'{archive}.tmp'
+        write_merged_data(matrix, tmp_file, index['geometry'], index['items'])
+        os.replace(tmp_file, archive)
+    _write_archive_cycles(archive, cycles + [times[0]])
+
+def _read_archive_cycles(archive):
+    #start times of the cycles written to the archive, kept next to it
+    cycle_file = f'{archive}.cycles.json'
+    if not os.path.isfile(cycle_file) or not os.path.isfile(archive):
+        return []
+    with open(cycle_file) as f:
+        return [pd.Timestamp(c) for c in json.load(f)]
+
+def _write_archive_cycles(archive, cycles):
+    cycle_file = f'{archive}.cycles.json'
+    tmp_file = f'{cycle_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(sorted(set([pd.Timestamp(c).isoformat() for c in cycles])), f)
+    os.replace(tmp_file, cycle_file)
+
+def _get_step_time(dfs, i):
+    axis = dfs.FileInfo.TimeAxis
+    if axis.TimeAxisType == TimeAxisType.CalendarEquidistant:
+        return pd.Timestamp(axis.StartDateTime + td(seconds=i*axis.TimeStepInSeconds()))
+    return pd.Timestamp(axis.StartDateTime + td(seconds=dfs.ReadItemTimeStep(1, i).Time))
+
+def _write_archive_steps(dfs, file, times, tail, n, src_times):
+    #overwrites the steps that are in the archive already and appends the others, copying raw values
+    src_steps = {t: i for i, t in enumerate(src_times)}
+    start = dfs.FileInfo.TimeAxis.StartDateTime
+    delete_value = dfs.FileInfo.DeleteValueFloat
+    src = DfsFileFactory.DfsGenericOpen(file)
+    try:
+        src_delete_value = src.FileInfo.DeleteValueFloat
+        for t in times:
+            i = src_steps[t]
+            if t in tail:
+                step = tail[t]
+            else:
+                step = n
+                n += 1
+            seconds = (t - pd.Timestamp(start)).total_seconds()
+            for item in range(1, len(src.ItemInfo)+1):
+                data = src.ReadItemTimeStep(item, i).Data
+                if src_delete_value != delete_value:
+                    data[data == src_delete_value] = delete_value
+                dfs.WriteItemTimeStep(item, step, seconds, data)
+    finally:
+        src.Close()
+
 def combine_dfs(files, outfile):
-    #read files
-    ds = []
-    for file in files:
-        ds.append(mikeio.read(file))
-    #read times
-    time = []
-    _time = []
-    for d in ds:
-        time.append(d.time)
-        _time.extend(d.time)
+    #read times from the headers
+    indexes = [get_dfs_index(file) for file in files]
     #find overlapping times
-    series = pd.Series(_time)
-    counts = series.value_counts()
-    matching = sorted(counts[counts==len(ds)].index.tolist())
-    ids = []
-    for t in time:
-        ids.append(np.searchsorted(t, matching))
-    #read only overlapping data
-    dat = []
-    for i,d in enumerate(ds):
-        dat.append(d.sel(time=ids[i])[0])
-    #make output
-    out = mikeio.Dataset(dat)
-    out.to_dfs(outfile)
+    matching = indexes[0]['time']
+    for index in indexes[1:]:
+        matching = matching.intersection(index['time'])
+    matching = matching.sort_values()
+    ids = [np.searchsorted(index['time'], matching) for index in indexes]
+    #read only overlapping data, one timestep at a time, first item of every file
+    geometry = indexes[0]['geometry']
+    srcs = [DfsFileFactory.DfsGenericOpen(file) for file in files]
+    try:
+        with Dfs2Writer(outfile,
+                        grid=geometry,
+                        items=[index['items'][0] for index in indexes],
+                        start_time=matching[0],
+                        timestep=get_timestep(matching)) as writer:
+            for k, t in enumerate(matching):
+                dat = []
+                for src, idx in zip(srcs, ids):
+                    d = src.ReadItemTimeStep(1, int(idx[k])).Data
+                    d[d == src.FileInfo.DeleteValueFloat] = np.nan
+                    dat.append(d)
+                writer.write(t, dat)
+    finally:
+        for src in srcs:
+            src.Close()
     
-################################################################################
\ No newline at end of file
+################################################################################
+
+class Dfs2Writer:
+
+    ############################################################################
+
+    def __init__(self, filename, grid=None, items=None, start_time=None, timestep=None, mode='w'):
+        #writes timesteps one at a time, on a calendar axis that can be appended to later unless a
+        #timestep in seconds is given for an equidistant axis
+        self.filename = filename
+        if mode == 'a':
+            self._dfs = DfsFileFactory.Dfs2FileOpenAppend(filename)
+        else:
+            msg = 'grid, items and start_time are needed to create a new dfs2 file...'
+            assert grid is not None and items is not None and start_time is not None, msg
+            self._dfs = self._create(grid, items, start_time, timestep)
+        self.start_time = self._dfs.FileInfo.TimeAxis.StartDateTime
+        self.delete_value = self._dfs.FileInfo.DeleteValueFloat
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ############################################################################
+
+    def write(self, time, data):
+        #one 2D array per item
+        seconds = (pd.Timestamp(time) - pd.Timestamp(self.start_time)).total_seconds()
+        for d in data:
+            d = np.array(d, dtype=np.float32)
+            d[np.isnan(d)] = self.delete_value
+            self._dfs.WriteItemTimeStepNext(seconds, d.ravel())
+
+    def close(self):
+        if self._dfs is not None:
+            self._dfs.Close()
+            self._dfs = None
+
+    ############################################################################
+
+    def _create(self, grid, items, start_time, timestep):
+        builder = DfsBuilder.Create('', 'mikeio', mikeio.__dfs_version__)
+        builder.SetDataType(0)
+        factory = DfsFactory()
+        #same header as mikeio writes, with the grid origin at the first cell
+        if grid.orientation == 0:
+            origin = (grid.x[0], grid.y[0])
+        else:
+            origin = grid.origin
+        builder.SetSpatialAxis(factory.CreateAxisEqD2(eumUnit.eumUmeter, grid.nx, 0, grid.dx, grid.ny, 0, grid.dy))
+        if grid.is_geo:
+            proj = factory.CreateProjectionGeoOrigin(grid.projection_string, *origin, grid.orientation)
+        else:
+            cart = Cartography.CreateProjOrigin(grid.projection_string, *origin, grid.orientation)
+            proj = factory.CreateProjectionGeoOrigin(wktProjectionString=grid.projection,
+                                                     lon0=cart.LonOrigin,
+                                                     lat0=cart.LatOrigin,
+                                                     orientation=cart.Orientation)
+        builder.SetGeographicalProjection(proj)
+        start_time = pd.Timestamp(start_time).to_pydatetime()
+        if timestep is None:
+            axis = factory.CreateTemporalNonEqCalendarAxis(mikeio.eum.TimeStepUnit.SECOND, start_time)
+        else:
+            axis = factory.CreateTemporalEqCalendarAxis(mikeio.eum.TimeStepUnit.SECOND, start_time, 0, timestep)
+        builder.SetTemporalAxis(axis)
+        for item in items:
+            builder.AddCreateDynamicItem(item.name,
+                                         eumQuantity.Create(item.type, item.unit),
+                                         DfsSimpleType.Float,
+                                         item.data_value_type)
+        builder.CreateFile(self.filename)
+        return builder.GetFile()
+
+################################################################################
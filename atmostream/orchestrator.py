@@ -0,0 +1,140 @@
+################################################################################
+
+import asyncio
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .engine import DownloadEngine
+
+################################################################################
+
+class StreamOrchestrator:
+
+    ############################################################################
+
+    def __init__(self, max_workers=16, max_per_host=6, bandwidth=None, host_bandwidth=None, engine=None,
+                 conversion=None):
+        #every forecast shares one session, one worker pool and the bandwidth caps
+        if engine is None:
+            engine = DownloadEngine(max_workers=max_workers,
+                                    max_per_host=max_per_host,
+                                    bandwidth=bandwidth,
+                                    host_bandwidth=host_bandwidth)
+        self.engine = engine
+        #optional ConversionQueue shared by every forecast streaming with background=True
+        self.conversion = conversion
+        self.streams = []
+        #streams step on their own threads, so a slow model never holds up the others
+        self._pool = None
+        self._pool_size = 0
+
+    ############################################################################
+
+    @property
+    def forecasts(self):
+        return [s['forecast'] for s in self.streams]
+
+    def add(self, forecast, priority=0):
+        msg = 'Forecast has no stream parameters, run forecast.set_stream_params first...'
+        assert hasattr(forecast, '_stream_params'), msg
+        forecast.set_engine(self.engine)
+        forecast.set_priority(priority)
+        if self.conversion is not None:
+            forecast.set_conversion_queue(self.conversion)
+        self.streams.append({'forecast': forecast,
+                             'priority': priority,
+                             'next': 0.0,
+                             'future': None,
+                             'started': False})
+        return forecast
+
+    def remove(self, forecast):
+        for s in [s for s in self.streams if s['forecast'] is forecast]:
+            self._finish_stream(s)
+            if s['started']:
+                forecast.stop_stream()
+            self.streams.remove(s)
+
+    def step(self):
+        #start every stream that is due and not already running, returns seconds until the next is due
+        #priority decides which stream gets free download workers and conversion slots first
+        for s in self.streams:
+            if s['future'] is not None and s['future'].done():
+                s['future'].result()
+                s['future'] = None
+        now = time()
+        due = [s for s in self.streams if s['future'] is None and s['next'] <= now]
+        for s in sorted(due, key=lambda s: -s['priority']):
+            #running streams are never due, their next poll is set once the pass is over
+            s['next'] = float('inf')
+            s['future'] = self.pool.submit(self._step_stream, s)
+        if len(self.streams) == 0:
+            return 0.0
+        return max(min([s['next'] for s in self.streams]) - time(), 0.0)
+
+    def run(self):
+        assert len(self.streams) > 0, 'No forecasts to stream, add some with self.add first...'
+        try:
+            while True:
+                delay = self.step()
+                running = [s['future'] for s in self.streams if s['future'] is not None]
+                #wake up when the next stream is due or a running one finishes its pass
+                if len(running) > 0:
+                    wait(running, timeout=None if delay == float('inf') else delay, return_when=FIRST_COMPLETED)
+                elif delay > 0:
+                    sleep(delay)
+        finally:
+            self.stop()
+
+    @property
+    def pool(self):
+        #one thread per stream, regrown when streams are added, passes already running carry on
+        if self._pool is None or self._pool_size < len(self.streams):
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool_size = max(len(self.streams), 1)
+            self._pool = ThreadPoolExecutor(max_workers=self._pool_size)
+        return self._pool
+
+    async def arun(self):
+        #every forecast runs its own asyncio stream, priority orders their downloads and conversions
+        assert len(self.streams) > 0, 'No forecasts to stream, add some with self.add first...'
+        streams = sorted(self.streams, key=lambda s: -s['priority'])
+        tasks = [asyncio.create_task(s['forecast'].astream()) for s in streams]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        #running passes are asked to stop and finished before their streams are closed
+        for s in self.streams:
+            state = getattr(s['forecast'], '_stream_state', None)
+            if s['future'] is not None and state is not None:
+                state['stop'].set()
+        for s in self.streams:
+            self._finish_stream(s)
+            if s['started']:
+                s['forecast'].stop_stream()
+                s['started'] = False
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    ############################################################################
+
+    def _step_stream(self, s):
+        if not s['started']:
+            s['forecast'].start_stream()
+            s['started'] = True
+        s['next'] = time() + s['forecast'].stream_step()
+
+    def _finish_stream(self, s):
+        #waits for a running pass, its errors are not raised again while stopping
+        if s['future'] is not None:
+            wait([s['future']])
+            s['future'] = None
+
+############################################################################
@@ -0,0 +1,124 @@
+################################################################################
+
+import os
+import json
+import numpy as np
+from datetime import datetime as dt
+from datetime import timedelta as td
+
+################################################################################
+
+class PollScheduler:
+
+    ############################################################################
+
+    def __init__(self, history_file=None, min_sleep=15, max_sleep=1800, window=600, max_history=10):
+        assert min_sleep <= max_sleep, 'min_sleep must not be larger than max_sleep...'
+        self.history_file = history_file
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.window = window
+        self.max_history = max_history
+        #{cycle hour: {lead: [seconds after cycle time the lead was first seen, ...]}}
+        self.history = {}
+        #{cycle time: set of leads seen so far}
+        self._seen = {}
+        if history_file is not None and os.path.isfile(history_file):
+            self._load()
+
+    ############################################################################
+
+    def observe(self, cycle_time, leads, now=None, appeared=False):
+        #the first look at a cycle only seeds what is already there, arrival times are unknown
+        #unless the cycle appeared while the stream was watching, then its leads are new as well
+        now = dt.utcnow() if now is None else now
+        cycle = cycle_time.strftime('%H')
+        leads = set(leads)
+        if cycle_time not in self._seen:
+            if not appeared:
+                self._seen[cycle_time] = leads
+                return []
+            self._seen[cycle_time] = set()
+        new = sorted(leads - self._seen[cycle_time])
+        if len(new) == 0:
+            return new
+        lag = (now - cycle_time).total_seconds()
+        cycle_history = self.history.setdefault(cycle, {})
+        for lead in new:
+            lags = cycle_history.setdefault(lead, [])
+            lags.append(lag)
+            del lags[:-self.max_history]
+        self._seen[cycle_time] |= set(new)
+        self._save()
+        return new
+
+    def expected_arrivals(self, cycle_time):
+        cycle_history = self.history.get(cycle_time.strftime('%H'), {})
+        return {lead: cycle_time + td(seconds=float(np.median(lags)))
+                for lead, lags in cycle_history.items() if len(lags) > 0}
+
+    def predict_next_arrival(self, cycle_time, now=None):
+        #earliest expected arrival of a lead not seen yet in this cycle
+        now = dt.utcnow() if now is None else now
+        seen = self._seen.get(cycle_time, set())
+        expected = self.expected_arrivals(cycle_time)
+        if len(expected) == 0:
+            return None
+        pending = [t for lead, t in expected.items() if lead not in seen]
+        if len(pending) == 0:
+            #this cycle is complete, the next arrival is the first lead of the next cycle
+            pending = list(self.expected_arrivals(self.next_cycle_time(cycle_time)).values())
+        if len(pending) == 0:
+            return None
+        return min(pending)
+
+    def next_cycle_time(self, cycle_time):
+        #cycle hours are learned from the history and the cycles looked at so far
+        hours = sorted(set([int(h) for h in self.history]) | set([c.hour for c in self._seen]) | set([cycle_time.hour]))
+        day = cycle_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        later = [h for h in hours if h > cycle_time.hour]
+        if len(later) > 0:
+            return day + td(hours=later[0])
+        return day + td(days=1, hours=hours[0])
+
+    def next_wait(self, cycle_time, default, now=None):
+        now = dt.utcnow() if now is None else now
+        predicted = self.predict_next_arrival(cycle_time, now=now)
+        if predicted is None:
+            wait = default
+        else:
+            delta = (predicted - now).total_seconds()
+            if delta > self.window:
+                #nothing expected for a while, sleep until the window opens
+                wait = delta - self.window
+            elif delta >= -self.window:
+                #inside the publication window, poll aggressively
+                wait = self.min_sleep
+            else:
+                #later than usual, fall back to the regular interval
+                wait = default
+        return min(max(wait, self.min_sleep), self.max_sleep)
+
+    def forget(self, before):
+        #drop the seen sets of cycles older than before
+        for cycle_time in [c for c in self._seen if c < before]:
+            del self._seen[cycle_time]
+
+    ############################################################################
+
+    def _load(self):
+        try:
+            with open(self.history_file) as f:
+                self.history = json.load(f)
+        except ValueError:
+            self.history = {}
+
+    def _save(self):
+        if self.history_file is None:
+            return
+        tmp_file = self.history_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.history, f)
+        os.replace(tmp_file, self.history_file)
+
+############################################################################
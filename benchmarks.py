@@ -0,0 +1,68 @@
+################################################################################
+
+import re
+import sys
+from timeit import timeit
+from bs4 import BeautifulSoup as bs
+
+from atmostream.listing import extract_hrefs
+
+################################################################################
+
+#listing pages in the formats served by NOMADS and the EC datamart, pass paths to
+#recorded pages on the command line to benchmark those instead
+
+def nomads_page(n):
+    rows = [f'<a href="gfs.t00z.pgrb2.0p25.f{i:03d}">gfs.t00z.pgrb2.0p25.f{i:03d}</a>'
+            f'                18-Oct-2026 03:{i%60:02d}  500M\n'
+            f'<a href="gfs.t00z.pgrb2.0p25.f{i:03d}.idx">gfs.t00z.pgrb2.0p25.f{i:03d}.idx</a>'
+            f'            18-Oct-2026 03:{i%60:02d}   30K\n' for i in range(n)]
+    return ('<html><head><title>Index of /pub/data/nccf/com/gfs/prod/gfs.20261018/00/atmos</title></head>\n'
+            '<body><h1>Index of /pub/data/nccf/com/gfs/prod/gfs.20261018/00/atmos</h1>\n'
+            '<hr><pre><a href="../">../</a>\n' + ''.join(rows) + '</pre><hr></body></html>\n')
+
+def datamart_page(n):
+    rows = [f'<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td>'
+            f'<td><a href="CMC_reg_PRES_SFC_0_ps10km_2026101800_P{i:03d}.grib2">'
+            f'CMC_reg_PRES_SFC_0_ps10km_2026101800_P{i:03d}.grib2</a></td>'
+            f'<td align="right">2026-10-18 03:{i%60:02d}  </td><td align="right">1.2M</td><td>&nbsp;</td></tr>\n'
+            for i in range(n)]
+    return ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html><head><title>Index of /model_gem_regional</title></head>'
+            '<body><h1>Index of /model_gem_regional</h1><table>\n'
+            '<tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th></tr>\n'
+            '<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="/model_gem_regional/">Parent Directory</a></td></tr>\n'
+            + ''.join(rows) + '</table></body></html>\n')
+
+#the parsing path used before the fast extractor
+def bs_hrefs(text, pattern):
+    soup = bs(text, features="html.parser")
+    return [m.get('href') for m in soup.find_all('a') if re.search(pattern, m.get('href'))]
+
+def fast_hrefs(text, pattern):
+    return [h for h in extract_hrefs(text) if pattern.search(h)]
+
+def bench(name, text, number=20):
+    pattern = '^gfs.t00z.|.grib2'
+    compiled = re.compile(pattern)
+    assert bs_hrefs(text, pattern) == fast_hrefs(text, compiled), f'{name}: extractors disagree...'
+    t_bs = timeit(lambda: bs_hrefs(text, pattern), number=number) / number
+    t_fast = timeit(lambda: fast_hrefs(text, compiled), number=number) / number
+    print(f'{name:<40} {len(text)/1e3:>8.0f} kB  bs4 {t_bs*1e3:>8.2f} ms  fast {t_fast*1e3:>7.2f} ms  x{t_bs/t_fast:>6.1f}')
+
+################################################################################
+
+if __name__ == '__main__':
+
+    ################################################################################
+    # listing parsing
+    ################################################################################
+
+    if len(sys.argv) > 1:
+        for pth in sys.argv[1:]:
+            with open(pth) as f:
+                bench(pth, f.read())
+    else:
+        bench('NOMADS GFS atmos (5000 files)', nomads_page(2500))
+        bench('EC datamart lead hour (500 files)', datamart_page(500))
+
+    ################################################################################
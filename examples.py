@@ -114,4 +114,21 @@ if __name__ == '__main__':
     # #stream data
     # fc.stream()
     
-    ################################################################################
\ No newline at end of file
+    ################################################################################
+    # Several models in one process
+    ################################################################################
+
+    # from atmostream import StreamOrchestrator
+    # #one shared connection pool, worker pool and 20 MB/s bandwidth budget
+    # orchestrator = StreamOrchestrator(max_workers=16, max_per_host=6, bandwidth=20e6)
+    # #higher priority models are handled first when several are due
+    # for model, priority in [('HRDPS_continental', 2), ('RDPS', 1), ('GDPS', 0)]:
+    #     fc = Forecast(model, output_path=f'{model}_test')
+    #     day = fc.get_available_days()[0]
+    #     forecast = fc.get_available_forecasts(day)[0]
+    #     fc.set_stream_params(day, forecast, fc.supported_vars, 300, convert_to_dfs=True, auto_delete=False, logging=True)
+    #     orchestrator.add(fc, priority=priority)
+    # #stream data
+    # orchestrator.run()
+
+    ################################################################################
@@ -12,14 +12,13 @@ setup(
     description="A pythonic approach to download, stream, and process various atmopsheric forecast models",
     include_package_data=True,
     packages=find_packages(),
-    install_requires=["beautifulsoup4",
-                      "requests",
+    install_requires=["requests",
                       "tqdm",
                       "pandas",
                       "mikeio",
-                      "xarray",
                       "numpy",
-                      "more_itertools"],
+                      "more_itertools",
+                      "eccodes"],
     dependency_links=[])
 
 ################################################################################